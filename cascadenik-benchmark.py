@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+""" Time parsing and compiling of the stylesheets bundled with Cascadenik.
+
+Results are written as JSON so they can be compared from one commit to
+the next, for example:
+
+  cascadenik-benchmark.py -o before.json
+  (change some things)
+  cascadenik-benchmark.py -o after.json --compare before.json
+
+With --scaling, generated stylesheets from cascadenik.synthetic are timed
+instead, growing one dimension at a time with the others held at 1, and
+a text plot of parse and compile time against each dimension is printed:
+
+  cascadenik-benchmark.py --scaling --sizes 1,2,4,6 -o scaling.json
+
+The cascadenik package next to this script is benchmarked, not any
+installed copy. If mapnik can't be imported, a stub module that accepts
+any call is used instead, so to_mapnik() still does all of its own work.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import types
+import shutil
+import optparse
+import tempfile
+import subprocess
+from os.path import dirname, realpath, join, relpath, exists
+
+root = dirname(realpath(__file__))
+
+class StubObject(object):
+    """ Stand-in for any mapnik class, instance, function or constant.
+
+        Accepts any arguments, has any attribute,
+        and keeps anything appended to it.
+    """
+    def __init__(self, *args, **kwargs):
+        self.__dict__['_items'] = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        value = StubObject()
+        self.__dict__[name] = value
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return StubObject()
+
+    def __nonzero__(self):
+        return True
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def append(self, item):
+        self._items.append(item)
+
+class StubModule(types.ModuleType):
+    """ Stand-in for the mapnik module, with a StubObject for every name.
+    """
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        return StubObject()
+
+def install_stub_mapnik():
+    """ Put a StubModule in place of mapnik, claiming to be mapnik 2.1.
+    """
+    stub = StubModule('mapnik', 'Stub mapnik module for benchmarks.')
+    stub.mapnik_version = lambda: 200100
+    sys.modules['mapnik'] = stub
+
+def git_commit():
+    """ Return the current git commit of this checkout, or None.
+    """
+    try:
+        git = subprocess.Popen(('git', 'rev-parse', 'HEAD'), cwd=root,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        commit, err = git.communicate()
+    except OSError:
+        return None
+
+    return git.returncode == 0 and commit.strip() or None
+
+def timings(function, repeat, reset=None):
+    """ Call a function repeat times, and return a list of wall times.
+
+        If reset is given, it's called untimed before each call.
+    """
+    times = []
+
+    for i in range(repeat):
+        if reset is not None:
+            reset()
+
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+
+    return times
+
+def benchmark(name, input, setup, repeat, reset=None):
+    """ Return a result dictionary for a named benchmark of one input.
+
+        Input is a file path relative to this script or a description of
+        generated input. Setup is called once with no arguments, and returns
+        the function to be timed. Reset is passed on to timings(). Errors
+        are recorded in the result instead of raised.
+    """
+    result = {'benchmark': name, 'input': input}
+
+    try:
+        times = timings(setup(), repeat, reset)
+    except Exception, e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    else:
+        result.update(times=times, best=min(times), mean=sum(times) / len(times))
+
+    print >> sys.stderr, format_result(result)
+    return result
+
+def clear_cached_declarations(cache_dir):
+    """ Remove parsed declarations and rule sets pickled by compile().
+
+        Downloaded and localized files are kept, so that only parsing
+        is repeated and not the network.
+    """
+    for path in glob.glob(join(cache_dir, '*.pickle')):
+        os.remove(path)
+
+def format_result(result):
+    if 'error' in result:
+        return '%-28s %-32s %s' % (result['benchmark'], result['input'], result['error'])
+
+    return '%-28s %-32s %8.3fs best %8.3fs mean' % (result['benchmark'], result['input'], result['best'], result['mean'])
+
+def main(repeat, stub_mapnik, sizes=None):
+    """ Run every benchmark, and return a dictionary of results.
+    
+        If a list of sizes is given, run scaling benchmarks instead.
+    """
+    sys.path.insert(0, root)
+
+    if stub_mapnik:
+        install_stub_mapnik()
+
+    import cascadenik
+
+    if sizes:
+        results = scaling_results(repeat, sizes)
+    else:
+        results = bundled_results(repeat)
+
+    return {'cascadenik': cascadenik.__version__,
+            'commit': git_commit(),
+            'mapnik': stub_mapnik and 'stub' or cascadenik.MAPNIK_VERSION_STR,
+            'python': sys.version.split()[0],
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': repeat,
+            'results': results}
+
+def bundled_results(repeat):
+    """ Time the stylesheets and maps bundled with Cascadenik, return results.
+    """
+    from cascadenik import mapnik, stylesheet_declarations
+    from cascadenik.compile import compile, Directories, tests_filter_combinations, selectors_tests
+
+    stylesheets = sorted(glob.glob(join(root, 'openstreetmap', '*.mss'))) \
+                + sorted(glob.glob(join(root, 'doc', 'example*.mss')))
+
+    maps = [join(root, 'openstreetmap', 'style.mml')] \
+         + sorted(glob.glob(join(root, 'doc', 'example*.mml')))
+
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='cascadenik-benchmark-')
+
+    try:
+        for path in stylesheets:
+            content = open(path).read().decode('utf-8')
+
+            def setup():
+                return lambda: stylesheet_declarations(content, is_merc=True)
+
+            results.append(benchmark('stylesheet_declarations', relpath(path, root), setup, repeat))
+
+        for path in stylesheets:
+            content = open(path).read().decode('utf-8')
+
+            def setup():
+                declarations = stylesheet_declarations(content, is_merc=True)
+                tests = selectors_tests([dec.selector for dec in declarations])
+                return lambda: tests_filter_combinations(tests)
+
+            results.append(benchmark('tests_filter_combinations', relpath(path, root), setup, repeat))
+
+        for path in maps:
+            dirs = Directories(tmpdir, tmpdir, dirname(path))
+
+            def setup():
+                return lambda: compile(path, dirs)
+
+            # every repeat parses, as if the stylesheets were never seen before
+            reset = lambda: clear_cached_declarations(tmpdir)
+            results.append(benchmark('compile', relpath(path, root), setup, repeat, reset))
+
+        for path in maps:
+            dirs = Directories(tmpdir, tmpdir, dirname(path))
+
+            def setup():
+                compile(path, dirs)
+                return lambda: compile(path, dirs)
+
+            results.append(benchmark('compile (cached)', relpath(path, root), setup, repeat))
+
+        for path in maps:
+            dirs = Directories(tmpdir, tmpdir, dirname(path))
+
+            def setup():
+                compiled = compile(path, dirs)
+                return lambda: compiled.to_mapnik(mapnik.Map(1, 1), dirs)
+
+            results.append(benchmark('to_mapnik', relpath(path, root), setup, repeat))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+def scaling_results(repeat, sizes):
+    """ Time generated stylesheets and maps of growing sizes, return results.
+    
+        Each dimension of cascadenik.synthetic is grown through the given
+        sizes in turn, with every other dimension held at 1.
+    """
+    from cascadenik import stylesheet_declarations, synthetic
+    from cascadenik.compile import compile, Directories
+
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='cascadenik-benchmark-')
+    dirs = Directories(tmpdir, tmpdir, tmpdir)
+
+    try:
+        for dimension in dimensions:
+            for size in sizes:
+                kwargs = {dimension: size}
+                input = '%s=%d' % (dimension, size)
+
+                def setup():
+                    content = synthetic.stylesheet(**kwargs)
+                    return lambda: stylesheet_declarations(content, is_merc=True)
+
+                results.append(benchmark('synthetic parse', input, setup, repeat))
+
+                def setup():
+                    mapfile = synthetic.mapfile(**kwargs)
+                    return lambda: compile(mapfile, dirs)
+
+                reset = lambda: clear_cached_declarations(tmpdir)
+                results.append(benchmark('synthetic compile', input, setup, repeat, reset))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+dimensions = ('layers', 'classes', 'attributes', 'zooms', 'depth')
+
+def plot(results, width=50):
+    """ Print best times of scaling results as bars, one group per dimension.
+    """
+    times = [result['best'] for result in results if 'best' in result]
+    longest = max(times or [0]) or 1
+
+    for dimension in dimensions:
+        print >> sys.stderr, '\n%s' % dimension
+
+        for result in results:
+            if not result['input'].startswith(dimension + '=') or 'best' not in result:
+                continue
+
+            bar = '#' * int(round(width * result['best'] / longest))
+            size = result['input'].split('=')[1]
+            print >> sys.stderr, '%4s %-18s %8.3fs %s' % (size, result['benchmark'], result['best'], bar)
+
+def compare(old, new):
+    """ Print best times from two sets of results side by side, with ratios.
+    """
+    old_results = dict([((r['benchmark'], r['input']), r) for r in old['results']])
+
+    print >> sys.stderr, '\n%-28s %-32s %9s %9s %7s' % ('benchmark', 'input', 'before', 'after', 'ratio')
+
+    for result in new['results']:
+        prev = old_results.get((result['benchmark'], result['input']), {})
+
+        if 'best' in result and 'best' in prev:
+            ratio = prev['best'] and '%6.2fx' % (result['best'] / prev['best']) or '-'
+            print >> sys.stderr, '%-28s %-32s %8.3fs %8.3fs %7s' % (result['benchmark'], result['input'], prev['best'], result['best'], ratio)
+
+parser = optparse.OptionParser(usage="""%prog [options]""")
+
+parser.set_defaults(repeat=3, output=None, compare=None, stub_mapnik=False, scaling=False, sizes='1,2,3,4,5,6')
+
+parser.add_option('-n', '--repeat', dest='repeat', type='int',
+                  help='Number of times to run each benchmark. (default: %default)')
+
+parser.add_option('-o', '--output', dest='output',
+                  help='Write JSON results to this file. (default: stdout)')
+
+parser.add_option('--compare', dest='compare',
+                  help='Compare results with those in an earlier JSON results file.')
+
+parser.add_option('--stub-mapnik', dest='stub_mapnik',
+                  help='Use a stub mapnik module even if mapnik can be imported. (default: only if it cannot)',
+                  action='store_true')
+
+parser.add_option('--scaling', dest='scaling',
+                  help='Time generated stylesheets of growing sizes instead of bundled ones, and plot the results.',
+                  action='store_true')
+
+parser.add_option('--sizes', dest='sizes',
+                  help='Comma-delimited sizes for each dimension with --scaling. (default: %default)')
+
+if __name__ == '__main__':
+    (options, args) = parser.parse_args()
+
+    stub_mapnik = options.stub_mapnik
+
+    if not stub_mapnik:
+        try:
+            import mapnik
+        except ImportError:
+            try:
+                import mapnik2
+            except ImportError:
+                stub_mapnik = True
+
+    sizes = options.scaling and map(int, options.sizes.split(',')) or None
+    results = main(options.repeat, stub_mapnik, sizes)
+
+    if options.output:
+        json.dump(results, open(options.output, 'w'), indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+
+    if sizes:
+        plot(results['results'])
+
+    if options.compare and exists(options.compare):
+        compare(json.load(open(options.compare)), results)
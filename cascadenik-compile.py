@@ -21,6 +21,17 @@ except ImportError:
         import elementtree.ElementTree as ElementTree
         from elementtree.ElementTree import Element
 
+def window_callback(option, opt, value, parser, type):
+    """ Parse a window like "14-18", "14-" or "-8" into a (min, max) pair.
+    """
+    try:
+        window = [(type(part) if part.strip() else None) for part in value.split('-')]
+        assert len(window) == 2
+    except (ValueError, AssertionError):
+        raise optparse.OptionValueError('%s wants a range like "14-18", "14-" or "-8", not "%s"' % (opt, value))
+    
+    setattr(parser.values, option.dest, tuple(window))
+
 def main(src_file, dest_file, **kwargs):
     """ Given an input layers file and a directory, print the compiled
         XML file to stdout and save any encountered external image files
@@ -29,7 +40,7 @@ def main(src_file, dest_file, **kwargs):
     mmap = mapnik.Map(1, 1)
     # allow [zoom] filters to work
     mmap.srs = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null'
-    load_kwargs = dict([(k, v) for (k, v) in kwargs.items() if k in ('cache_dir', 'scale', 'verbose', 'datasources_cfg', 'user_styles')])
+    load_kwargs = dict([(k, v) for (k, v) in kwargs.items() if k in ('cache_dir', 'scale', 'verbose', 'datasources_cfg', 'user_styles', 'workers', 'zooms', 'scales', 'profile')])
     cascadenik.load_map(mmap, src_file, dirname(realpath(dest_file)), **load_kwargs)
     
     (handle, tmp_file) = tempfile.mkstemp(suffix='.xml', prefix='cascadenik-mapnik-')
@@ -53,7 +64,7 @@ def main(src_file, dest_file, **kwargs):
 
 parser = optparse.OptionParser(usage="""%prog [options] <mml> <xml>""", version='%prog ' + cascadenik.__version__)
 
-parser.set_defaults(cache_dir=None, pretty=True, verbose=False, scale=1, user_styles=[], datasources_cfg=None)
+parser.set_defaults(cache_dir=None, pretty=True, verbose=False, scale=1, user_styles=[], datasources_cfg=None, workers=1, zooms=None, scales=None, profile=False)
 
 # the actual default for cache_dir is handled in load_map(),
 # to ensure that the mkdir behavior is correct.
@@ -73,6 +84,21 @@ parser.add_option('--2x', dest='scale', action='store_const', const=2,
 parser.add_option('--style', dest='user_styles', action='append',
                   help='Look for additional styles in the named file, which will override anything provided in the MML. Any number of these can be provided.')
 
+parser.add_option('--zooms', dest='zooms', type='string',
+                  action='callback', callback=window_callback, callback_args=(int, ),
+                  help='Only compile for a range of zoom levels like "14-18", "14-" or "-8", dropping everything else. (default: all)')
+
+parser.add_option('--scales', dest='scales', type='string',
+                  action='callback', callback=window_callback, callback_args=(float, ),
+                  help='Only compile for a range of scale denominators like "1000-50000", dropping everything else. (default: all)')
+
+parser.add_option('-j', '--jobs', dest='workers', type='int',
+                  help='Parse stylesheets and compile layer styles in this many parallel processes. (default: 1)')
+
+parser.add_option('--profile', dest='profile',
+                  help='Print time spent in each phase of compiling, and filter and rule counts for each layer. (default: False)',
+                  action='store_true')
+
 parser.add_option('-p', '--pretty', dest='pretty',
                   help='Pretty print the xml output. (default: True)',
                   action='store_true')
@@ -1,20 +1,15 @@
 #!/usr/bin/env python
 
 import sys
-import os.path
 import optparse
 import cascadenik
 
-# monkey with sys.path due to some weirdness inside cssutils
-sys.path.append(os.path.dirname(os.path.realpath(__file__)))
-from cssutils.tokenize2 import Tokenizer as cssTokenizer
-
 def main(filename):
     """ Given an input file containing nothing but styles, print out an
         unrolled list of declarations in cascade order.
     """
     input = open(filename, 'r').read()
-    declarations = cascadenik.stylesheet_declarations(input, is_merc=True)
+    declarations = cascadenik.iter_stylesheet_declarations(input, is_merc=True)
     
     for dec in declarations:
         print dec.selector,
@@ -8,6 +8,7 @@ The code:
 """
 __version__ = '2.6.5'
 
+from sys import stderr
 from os import mkdir, chmod
 from os.path import isdir, realpath, expanduser, dirname, exists
 from urlparse import urlparse
@@ -26,7 +27,7 @@ MAPNIK_VERSION_STR = ('%07d' % MAPNIK_VERSION)
 MAPNIK_VERSION_STR = '.'.join(map(str, (int(MAPNIK_VERSION_STR[:2]), int(MAPNIK_VERSION_STR[2:-2]), int(MAPNIK_VERSION_STR[-2:]))))
 
 from . import style
-from .parse import stylesheet_declarations
+from .parse import stylesheet_declarations, iter_stylesheet_declarations
 
 # compile module -> "_compile"
 from . import compile as _compile
@@ -39,7 +40,7 @@ CACHE_DIR = '~/.cascadenik'
 
 __all__ = ['load_map', 'compile', '_compile', 'style', 'stylesheet_declarations']
 
-def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg=None, user_styles=[], verbose=False):
+def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg=None, user_styles=[], verbose=False, workers=1, zooms=None, scales=None, profile=False):
     """ Apply a stylesheet source file to a given mapnik Map instance, like mapnik.load_map().
     
         Parameters:
@@ -60,7 +61,8 @@ def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg
             Optional scale value for output map, 2 doubles the size for high-res displays.
         
           cache_dir:
-            ...
+            Directory for downloaded files and parsed stylesheets, so they
+            can be reused by later runs. Default ~/.cascadenik.
         
           datasources_cfg:
             ...
@@ -72,6 +74,19 @@ def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg
         
           verbose:
             ...
+        
+          workers:
+            Number of processes used to parse stylesheets and compile layer styles, default 1.
+        
+          zooms:
+            Optional (min, max) pair of zoom levels to compile for, see compile().
+        
+          scales:
+            Optional (min, max) pair of scale denominators to compile for, see compile().
+        
+          profile:
+            If True, print wall time and call counts for each phase of the
+            compile and to_mapnik(), and counts for each layer, to stderr.
     """
     scheme, n, path, p, q, f = urlparse(src_file)
     
@@ -87,4 +102,12 @@ def load_map(map, src_file, output_dir, scale=1, cache_dir=None, datasources_cfg
             chmod(cache_dir, 0755)
 
     dirs = Directories(output_dir, realpath(cache_dir), dirname(src_file))
-    compile(src_file, dirs, verbose, datasources_cfg=datasources_cfg, user_styles=user_styles, scale=scale).to_mapnik(map, dirs)
+    compiled = compile(src_file, dirs, verbose, datasources_cfg=datasources_cfg, user_styles=user_styles,
+                       scale=scale, workers=workers, zooms=zooms, scales=scales, profile=profile)
+    
+    if profile:
+        compiled.profile.call('to_mapnik', compiled.to_mapnik, map, dirs)
+        stderr.write(str(compiled.profile))
+    
+    else:
+        compiled.to_mapnik(map, dirs)
@@ -10,10 +10,14 @@ import posixpath
 import os.path as systempath
 import zipfile
 import shutil
+import heapq
+import multiprocessing
+import cPickle
 
 from hashlib import md5
+from itertools import chain
 from datetime import datetime
-from time import strftime, localtime
+from time import time, strftime, localtime
 from re import sub, compile, MULTILINE
 from urlparse import urlparse, urljoin
 from operator import lt, le, eq, ge, gt
@@ -55,9 +59,9 @@ else:
 
 # cascadenik
 from . import safe64, style, output, sources
-from . import MAPNIK_VERSION, MAPNIK_VERSION_STR
+from . import MAPNIK_VERSION, MAPNIK_VERSION_STR, __version__
 from .nonposix import un_posix, to_posix
-from .parse import stylesheet_declarations
+from .parse import stylesheet_declarations, RulesetCache
 from .style import uri
 
 try:
@@ -74,6 +78,10 @@ if not Image:
 
 DEFAULT_ENCODING = 'utf-8'
 
+# Bump this whenever the pickled layout of declarations, selectors, values
+# or rule sets changes, so caches left by older code are not read back.
+CACHE_FORMAT = 3
+
 try:
     import xml.etree.ElementTree as ElementTree
     from xml.etree.ElementTree import Element
@@ -94,6 +102,66 @@ def msg(msg):
     if VERBOSE:
         sys.stderr.write('Cascadenik debug: %s\n' % msg)
 
+class Profile:
+    """ Wall time and call counts for the phases of a compile, and counts
+        of filter combinations generated and kept and rules emitted by layer.
+    """
+    def __init__(self):
+        self.phases = {}
+        self.layers = []
+        self.combinations = 0
+        self.kept = 0
+    
+    def call(self, phase, function, *args, **kwargs):
+        """ Call a function, adding its wall time to the named phase.
+        """
+        start = time()
+        
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.add(phase, time() - start)
+    
+    def add(self, phase, seconds, calls=1):
+        """ Add some wall time and calls to the named phase.
+        """
+        prev_calls, prev_seconds = self.phases.get(phase, (0, 0.))
+        self.phases[phase] = prev_calls + calls, prev_seconds + seconds
+    
+    def merge(self, other):
+        """ Add all the phases from another Profile to this one.
+        """
+        for (phase, (calls, seconds)) in other.phases.items():
+            self.add(phase, seconds, calls)
+    
+    def addLayer(self, name, combinations, kept, rules):
+        self.layers.append((name, combinations, kept, rules))
+    
+    def __str__(self):
+        lines = ['%-40s %8s %10s' % ('phase', 'calls', 'seconds')]
+        
+        for (phase, (calls, seconds)) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            lines.append('%-40s %8d %10.3f' % (phase, calls, seconds))
+        
+        lines.append('')
+        lines.append('%-40s %12s %8s %8s' % ('layer', 'combinations', 'kept', 'rules'))
+        
+        for (name, combinations, kept, rules) in self.layers:
+            lines.append('%-40s %12d %8d %8d' % (name, combinations, kept, rules))
+        
+        return '\n'.join(lines) + '\n'
+
+# a Profile while compile() is profiling
+PROFILE = None
+
+def profiled(phase, function, *args, **kwargs):
+    """ Call a function, timing it under the named phase if compile() is profiling.
+    """
+    if PROFILE is None:
+        return function(*args, **kwargs)
+    
+    return PROFILE.call(phase, function, *args, **kwargs)
+
 counter = 0
 
 def next_counter():
@@ -330,14 +398,15 @@ class Filter:
     def __cmp__(self, other):
         """
         """
-        # get the scale tests to the front of the line, followed by regular alphabetical
-        key_func = lambda t: (not t.isMapScaled(), t.property, t.op, t.value)
+        return cmp(tests_sort_tuples(self.tests), tests_sort_tuples(other.tests))
 
-        # extract tests into cleanly-sortable tuples
-        self_tuples = [(t.property, t.op, t.value) for t in sorted(self.tests, key=key_func)]
-        other_tuples = [(t.property, t.op, t.value) for t in sorted(other.tests, key=key_func)]
-        
-        return cmp(self_tuples, other_tuples)
+def tests_sort_tuples(tests):
+    """ Return a list of cleanly-sortable tuples for a list of tests.
+    
+        Scale tests are brought to the front of the line, followed by
+        regular alphabetical. Used to put Filters in order.
+    """
+    return [test.key for test in sorted(tests)]
 
 def test_ranges(tests):
     """ Given a list of tests, return a list of Ranges that fully describes
@@ -529,15 +598,25 @@ def selectors_tests(selectors, property=None):
     for selector in selectors:
         for test in selector.allTests():
             if property is None or test.property == property:
-                tests[unicode(test)] = test
+                tests[test] = test
 
     return tests.values()
 
 def tests_filter_combinations(tests):
     """ Return a complete list of filter combinations for given list of tests
     """
+    return list(iter_tests_filter_combinations(tests))
+
+def tests_filter_groups(tests):
+    """ Divide a list of tests into per-property groups of legal combinations.
+    
+        Return a list of (property, choices, prefixed) tuples, one for each
+        property, in the order that Filters sort by. Choices is a sorted list
+        of (sort tuples, tests) pairs, and prefixed is true when one choice
+        is a prefix of another. Return None if there are no filters to make.
+    """
     if len(tests) == 0:
-        return [Filter()]
+        return None
     
     # unique properties
     properties = sorted(list(set([test.property for test in tests])))
@@ -562,27 +641,81 @@ def tests_filter_combinations(tests):
 
         else:
             property_tests[property] = test_combinations(current_tests)
-            
-    # get a list of the number of combinations for each group of tests from above.
-    property_counts = [len(property_tests[property]) for property in properties]
     
-    filters = []
-        
-    # now iterate over each combination - for large numbers of tests, this can get big really, really fast
-    for property_indexes in xindexes(property_counts):
-        # list of lists of tests
-        testslist = [property_tests[properties[i]][j] for (i, j) in enumerate(property_indexes)]
+    if 0 in [len(property_tests[property]) for property in properties]:
+        return None
+    
+    #
+    # Filters sort by their tests with scale tests first, followed by regular
+    # alphabetical, so picking one group of tests per property in that same
+    # order visits the filters in sorted order. See tests_sort_tuples().
+    #
+    groups = []
+    
+    for property in sorted(properties, key=lambda p: (p != 'scale-denominator', p)):
+        choices = sorted([(tests_sort_tuples(testlist), testlist) for testlist in property_tests[property]])
         
-        # corresponding filter
-        filter = Filter(*reduce(operator.add, testslist))
+        # when one choice is a prefix of another, following properties can
+        # end up interleaved between them, and need to be merged in order.
+        prefixed = [a == b[:len(a)] for ((a, ta), (b, tb)) in zip(choices[:-1], choices[1:])]
         
-        filters.append(filter)
+        groups.append((property, choices, True in prefixed))
+    
+    return groups
 
-    if len(filters):
-        return sorted(filters)
+def iter_tests_filter_combinations(tests, selectors=None):
+    """ Generate filter combinations for given list of tests, in sorted order.
+    
+        Filters are produced lazily, without building the complete list first.
+        If a list of selectors is provided, combinations are dropped as soon
+        as no selector in the list could apply to them, so that the amount
+        of work follows the number of useful filters instead of the size
+        of the full cross-product of tests.
+    """
+    return iter_groups_filter_combinations(tests_filter_groups(tests), selectors)
 
-    # if no filters have been defined, return a blank one that matches anything
-    return [Filter()]
+def iter_groups_filter_combinations(groups, selectors=None):
+    """ Generate filter combinations for groups from tests_filter_groups().
+    
+        See iter_tests_filter_combinations() for the meaning of selectors.
+    """
+    if groups is None:
+        # if no filters have been defined, return a blank one that matches anything
+        yield Filter()
+        return
+    
+    def combinations(depth, chosen):
+        """ Generate (sort tuples, filter) pairs for all groups from depth onward.
+        """
+        property, choices, prefixed = groups[depth]
+        branches = []
+        
+        for (tuples, testlist) in choices:
+            chosen_ = chosen + [(property, tuples, testlist)]
+            
+            if selectors is not None:
+                partial = Filter(*reduce(operator.add, [t for (p, tu, t) in chosen_]))
+                
+                if not any(is_applicable_selector(selector, partial) for selector in selectors):
+                    # neither this nor any narrower filter would match anything.
+                    continue
+            
+            if depth + 1 < len(groups):
+                branches.append(combinations(depth + 1, chosen_))
+            
+            else:
+                # tests in the filter itself are kept in alphabetical order of property
+                tuples = reduce(operator.add, [tu for (p, tu, t) in chosen_])
+                testslist = [t for (p, tu, t) in sorted(chosen_)]
+                branches.append([(tuples, Filter(*reduce(operator.add, testslist)))])
+        
+        if prefixed:
+            return heapq.merge(*branches)
+        
+        return chain(*branches)
+    
+    for (tuples, filter) in combinations(0, []):
+        yield filter
 
 def is_merc_projection(srs):
     """ Return true if the map projection matches that used by VEarth, Google, OSM, etc.
@@ -607,11 +740,95 @@ def is_merc_projection(srs):
 
     return True
 
-def extract_declarations(map_el, dirs, scale=1, user_styles=[]):
+def cached_stylesheet_declarations(content, is_merc, scale, cache_dir, mss_href=None, index=0):
+    """ Return the same list of declarations as stylesheet_declarations(),
+        from a pickle in the cache directory if the stylesheet was seen before.
+    
+        Cached declarations are checked against a key of content, projection,
+        scale, Cascadenik version and CACHE_FORMAT, so changing any of them
+        causes a fresh parse.
+        
+        If mss_href is given, cache files belong to that stylesheet and its
+        index among the stylesheets of a map, and are replaced after an edit
+        instead of added to. A RulesetCache is kept for it too, so after an
+        edit only changed rule sets are parsed. Without mss_href, cache files
+        belong to the content.
+    """
+    key = md5(content.encode('utf-8') + repr((bool(is_merc), scale, __version__, CACHE_FORMAT))).hexdigest()
+    
+    if mss_href is None:
+        source_key = key
+    else:
+        source_key = md5(repr((mss_href, index, bool(is_merc), scale, __version__, CACHE_FORMAT))).hexdigest()
+    
+    cache_path = posixpath.join(cache_dir, 'declarations-%s.pickle' % source_key)
+    cached = read_cache_pickle(cache_path)
+    
+    if cached is not None and cached[0] == key:
+        msg('Read cached declarations from %s' % cache_path)
+        return cached[1]
+
+    if mss_href is None:
+        declarations = profiled('stylesheet_declarations', stylesheet_declarations, content, is_merc, scale)
+    
+    else:
+        rulesets_path = posixpath.join(cache_dir, 'rulesets-%s.pickle' % source_key)
+        rulesets = read_cache_pickle(rulesets_path) or RulesetCache()
+        
+        declarations = profiled('stylesheet_declarations', stylesheet_declarations, content, is_merc, scale, cache=rulesets)
+        write_cache_pickle(rulesets_path, rulesets)
+    
+    write_cache_pickle(cache_path, (key, declarations))
+    
+    return declarations
+
+def read_cache_pickle(path):
+    """ Return an object from a pickle file in the cache directory, or None.
+    """
+    if not posixpath.exists(un_posix(path)):
+        return None
+
+    try:
+        return cPickle.load(open(un_posix(path), 'rb'))
+    except Exception, e:
+        msg('Ignoring unreadable cache file %s: %s' % (path, e))
+        return None
+
+def write_cache_pickle(path, object):
+    """ Write an object to a pickle file in the cache directory, if it exists.
+    """
+    cache_dir, filename = posixpath.split(path)
+    
+    if posixpath.isdir(un_posix(cache_dir)):
+        replace_file(path, lambda file: cPickle.dump(object, file, cPickle.HIGHEST_PROTOCOL))
+
+def replace_file(path, write):
+    """ Call write() with an open temporary file next to path, then move it
+        into place, so no other process ever reads or writes half of it.
+    """
+    dir, filename = posixpath.split(path)
+    handle, temp_path = tempfile.mkstemp(dir=un_posix(dir or '.'), prefix=filename.split('-')[0] + '-')
+    temp_file = os.fdopen(handle, 'wb')
+    
+    try:
+        write(temp_file)
+    finally:
+        temp_file.close()
+    
+    # mkstemp() makes files readable only by their owner
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, un_posix(path))
+
+def extract_declarations(map_el, dirs, scale=1, user_styles=[], workers=1):
     """ Given a Map element and directories object, remove and return a complete
         list of style declarations from any Stylesheet elements found within.
+        
+        With more than one worker, stylesheets are fetched and parsed in a
+        pool of processes. Declarations come back in document order either way,
+        and work done in the pool is added to the profile if compile() is profiling.
     """
     styles = []
+    is_merc = is_merc_projection(map_el.get('srs',''))
     
     #
     # First, look at all the stylesheets defined in the map itself.
@@ -619,26 +836,47 @@ def extract_declarations(map_el, dirs, scale=1, user_styles=[]):
     for stylesheet in map_el.findall('Stylesheet'):
         map_el.remove(stylesheet)
 
-        content, mss_href = fetch_embedded_or_remote_src(stylesheet, dirs)
+        if 'src' in stylesheet.attrib:
+            mss_href = urljoin(dirs.source.rstrip('/')+'/', stylesheet.attrib['src'])
+            styles.append((None, mss_href, is_merc, scale, dirs.cache))
         
-        if content:
-            styles.append((content, mss_href))
+        elif stylesheet.text:
+            styles.append((stylesheet.text, dirs.source.rstrip('/')+'/', is_merc, scale, dirs.cache))
     
     #
     # Second, look through the user-supplied styles for override rules.
     #
     for stylesheet in user_styles:
         mss_href = urljoin(dirs.source.rstrip('/')+'/', stylesheet)
-        content = urllib.urlopen(mss_href).read().decode(DEFAULT_ENCODING)
-
-        styles.append((content, mss_href))
+        styles.append((None, mss_href, is_merc, scale, dirs.cache))
     
-    declarations = []
+    # inline stylesheets share an href, so each one is cached by its index too
+    styles = [style + (index, ) for (index, style) in enumerate(styles)]
     
-    for (content, mss_href) in styles:
-        is_merc = is_merc_projection(map_el.get('srs',''))
+    if workers > 1 and len(styles) > 1:
+        msg('Parsing %d stylesheets with %d workers' % (len(styles), workers))
+        pool = multiprocessing.Pool(min(workers, len(styles)))
+        
+        try:
+            results = pool.map(_pooled_stylesheet_declarations, [(style, PROFILE is not None) for style in styles])
+        finally:
+            pool.terminate()
         
-        for declaration in stylesheet_declarations(content, is_merc, scale):
+        stylesheets = []
+        
+        for (mss_declarations, mss_profile) in results:
+            if mss_profile is not None:
+                PROFILE.merge(mss_profile)
+            
+            stylesheets.append(mss_declarations)
+    
+    else:
+        stylesheets = map(_fetched_stylesheet_declarations, styles)
+    
+    declarations = []
+    
+    for (mss_declarations, (content, mss_href, is_merc, scale, cache_dir, index)) in zip(stylesheets, styles):
+        for declaration in mss_declarations:
             #
             # Change the value of each URI relative to the location
             # of the containing stylesheet. We generally just have
@@ -655,6 +893,31 @@ def extract_declarations(map_el, dirs, scale=1, user_styles=[]):
 
     return declarations
 
+def _fetched_stylesheet_declarations(args):
+    """ Single-argument cached_stylesheet_declarations() for multiprocessing.Pool.map().
+    
+        Content is read from mss_href first if it's None.
+    """
+    content, mss_href, is_merc, scale, cache_dir, index = args
+    
+    if content is None:
+        content = urllib.urlopen(mss_href).read().decode(DEFAULT_ENCODING)
+    
+    return cached_stylesheet_declarations(content, is_merc, scale, cache_dir, mss_href, index)
+
+def _pooled_stylesheet_declarations(args):
+    """ _fetched_stylesheet_declarations() for a worker process, returning
+        declarations and a Profile of the work if profile is true or None.
+    
+        Workers can't add to the PROFILE of the parent process, so each
+        one counts into a fresh Profile of its own to be merged there.
+    """
+    global PROFILE
+    style, profile = args
+    PROFILE = profile and Profile() or None
+    
+    return _fetched_stylesheet_declarations(style), PROFILE
+
 def fetch_embedded_or_remote_src(elem, dirs):
     """
     """
@@ -788,11 +1051,7 @@ def is_applicable_selector(selector, filter):
     """ Given a Selector and Filter, return True if the Selector is
         compatible with the given Filter, and False if they contradict.
     """
-    for test in selector.allTests():
-        if not test.isCompatible(filter.tests):
-            return False
-    
-    return True
+    return selector.isCompatible(filter.tests)
 
 def get_map_attributes(declarations):
     """
@@ -803,35 +1062,135 @@ def get_map_attributes(declarations):
                  for dec in declarations
                  if dec.property.name in property_map])
 
-def filtered_property_declarations(declarations, property_names):
+class CascadeContext:
+    """ Shared state for cascading the declarations of a single layer.
+    
+        Every symbolizer family in a layer divides up the same attribute
+        space, so partitions of tests into filter groups are kept here,
+        keyed on the set of tests, and reused from one family to the next.
+    
+        Engine is the name of one of the cascade_engines, and decides how
+        the attribute space is divided up; every engine has the same result.
+        
+        Window is an optional Filter from scale_window(), and rules are
+        clipped to it.
+        
+        Combinations and kept count filters looked at by the engine
+        and filters that made it into rules, for profiling.
     """
+    def __init__(self, engine='cartesian', window=None):
+        assert engine in cascade_engines, 'Unknown cascade engine "%s"' % engine
+        
+        self.engine = engine
+        self.window = window
+        self.partitions = {}
+        self.combinations = 0
+        self.kept = 0
+    
+    def filterGroups(self, tests):
+        """ Return tests_filter_groups() for a list of tests, computing it only once.
+        """
+        # 1 == 1.0, but tests of ints and floats are different tests
+        key = frozenset([(test.property, test.op, test.value, type(test.value)) for test in tests])
+        
+        if key not in self.partitions:
+            self.partitions[key] = tests_filter_groups(tests)
+        
+        return self.partitions[key]
+    
+    def cascade(self, declarations):
+        """ Return a list of (filter, rule) pairs for a list of declarations.
+        """
+        rules = cascade_engines[self.engine](declarations, self)
+        self.kept += len(rules)
+        
+        if self.window is not None:
+            rules = clip_rules(rules, self.window)
+        
+        return rules
+
+def filtered_property_declarations(declarations, property_names, context=None):
+    """ Return a list of (filter, rule) pairs for declarations with the given
+        property names, where rule is a dictionary of property values.
+    
+        Optional context is a CascadeContext shared by other calls for the
+        same layer; a new one using the default engine is made if needed.
     """
     property_names += ['display']
 
     # just the ones we care about here
     declarations = [dec for dec in declarations if dec.property.name in property_names]
+    
+    return coalesce_rules((context or CascadeContext()).cascade(declarations))
+
+def cascade_rule(declarations):
+    """ Collect applicable declarations into a dictionary of property values.
+    
+        Return an empty dictionary if there's nothing to display.
+    """
+    rule = {}
+    
+    for dec in declarations:
+        rule[dec.property.name] = dec.value
+        
+        # Presence of display: none means don't add this rule at all.
+        if (dec.property.name, dec.value.value) == ('display', 'none'):
+            return {}
+
+    # Presence of display here probably just means display: map,
+    # which is boring and can be discarded.
+    if 'display' in rule:
+        del rule['display']
+    
+    return rule
+
+def cartesian_cascade(declarations, context):
+    """ Cascade declarations by checking each one against every filter
+        from the product of all tests, in order.
+    """
     selectors = [dec.selector for dec in declarations]
+    
+    # display alone never makes a rule, so only these can keep a filter alive
+    styling_selectors = [dec.selector for dec in declarations if dec.property.name != 'display']
+    
+    #
+    # Index declarations by the properties they test. Tests only ever
+    # conflict with tests of the same property, so a filter test needs
+    # to be checked against just that bucket, and the conflicts for each
+    # distinct filter test are found once. Declarations with no tests
+    # are in no bucket and apply to every filter.
+    #
+    property_declarations, conflicts = {}, {}
+    
+    for (i, dec) in enumerate(declarations):
+        for test in dec.selector.allTests():
+            property_declarations.setdefault(test.property, []).append((i, test))
+    
+    def test_conflicts(test):
+        """ Return a set of indexes of declarations that contradict a filter test.
+        """
+        key = test.property, test.op, test.value
+        
+        if key not in conflicts:
+            conflicts[key] = set([i for (i, dec_test) in property_declarations.get(test.property, [])
+                                  if not dec_test.isCompatible([test])])
+        
+        return conflicts[key]
 
     # a place to put rules
     rules = []
     
-    for filter in tests_filter_combinations(selectors_tests(selectors)):
-        rule = {}
+    groups = context.filterGroups(selectors_tests(selectors))
+    
+    for filter in iter_groups_filter_combinations(groups, styling_selectors):
+        context.combinations += 1
+        excluded = set()
+        
+        for test in filter.tests:
+            excluded |= test_conflicts(test)
         
         # collect all the applicable declarations into a list of parameters and values
-        for dec in declarations:
-            if is_applicable_selector(dec.selector, filter):
-                rule[dec.property.name] = dec.value
-                
-                # Presence of display: none means don't add this rule at all.
-                if (dec.property.name, dec.value.value) == ('display', 'none'):
-                    rule = {}
-                    break
-
-        # Presence of display here probably just means display: map,
-        # which is boring and can be discarded.
-        if rule and 'display' in rule:
-            del rule['display']
+        rule = cascade_rule([dec for (i, dec) in enumerate(declarations) if i not in excluded])
         
         # If the rule is empty by this point, skip it.
         if not rule:
@@ -841,7 +1200,292 @@ def filtered_property_declarations(declarations, property_names):
     
     return rules
 
-def get_polygon_rules(declarations):
+def diagram_cascade(declarations, context):
+    """ Cascade declarations over a decision diagram of per-property test groups.
+    
+        Each group choice is checked against each declaration just once,
+        and the set of declarations still applicable at a node is kept as
+        a bitmask. Nodes at the same depth with the same surviving
+        declarations describe equivalent regions of the attribute space,
+        so they are computed once and shared.
+    """
+    groups = context.filterGroups(selectors_tests([dec.selector for dec in declarations]))
+    
+    if groups is None:
+        return cartesian_cascade(declarations, context)
+    
+    # declarations that can keep a region alive, see cartesian_cascade()
+    styling = sum([1 << i for (i, dec) in enumerate(declarations) if dec.property.name != 'display'])
+    
+    # masks of declarations compatible with each choice, by group.
+    # tests on other properties never conflict, so each check is final.
+    masks = []
+    
+    for (property, choices, prefixed) in groups:
+        masks.append([sum([1 << i for (i, dec) in enumerate(declarations)
+                           if is_applicable_selector(dec.selector, Filter(*testlist))])
+                      for (tuples, testlist) in choices])
+    
+    rules, regions = {}, {}
+    
+    def mask_rule(mask):
+        if mask not in rules:
+            rules[mask] = cascade_rule([dec for (i, dec) in enumerate(declarations) if mask & (1 << i)])
+        
+        return rules[mask]
+    
+    def region_rules(depth, mask):
+        """ Return a list of (sort tuples, choices, rule) for groups from depth onward.
+        """
+        if (depth, mask) in regions:
+            return regions[(depth, mask)]
+        
+        property, choices, prefixed = groups[depth]
+        branches = []
+        
+        for ((tuples, testlist), choice_mask) in zip(choices, masks[depth]):
+            mask_ = mask & choice_mask
+            
+            if not mask_ & styling:
+                # nothing left that could make a rule here
+                continue
+            
+            if depth + 1 < len(groups):
+                branches.append([(tuples + tu, [(property, testlist)] + ch, rule)
+                                 for (tu, ch, rule) in region_rules(depth + 1, mask_)])
+            
+            else:
+                context.combinations += 1
+                
+                if mask_rule(mask_):
+                    branches.append([(tuples, [(property, testlist)], mask_rule(mask_))])
+        
+        if prefixed:
+            regions[(depth, mask)] = list(heapq.merge(*branches))
+        else:
+            regions[(depth, mask)] = list(chain(*branches))
+        
+        return regions[(depth, mask)]
+    
+    everything = (1 << len(declarations)) - 1
+    
+    # tests in each filter are kept in alphabetical order of property
+    return [(Filter(*reduce(operator.add, [t for (p, t) in sorted(choices)])), dict(rule))
+            for (tuples, choices, rule) in region_rules(0, everything)]
+
+cascade_engines = {'cartesian': cartesian_cascade, 'diagram': diagram_cascade}
+
+complement_ops = {'=': '!=', '!=': '=', '<': '>=', '>=': '<', '<=': '>', '>': '<='}
+
+def coalesced_filter(filter1, filter2):
+    """ Return a single Filter matching exactly what either of two disjoint
+        filters match, or None if there isn't a simple one.
+    
+        Two cases are understood: filters that differ only by a test and
+        its negation, like [kind=park] and [kind!=park], and adjacent slices
+        of scale-denominator, like (100 ... <1000) and (1000>= ... <5000).
+        Other range tests are left alone, because Mapnik finds neither
+        side of a comparison true for a missing attribute.
+    """
+    keys1 = [(test.property, test.op, test.value) for test in filter1.tests]
+    keys2 = [(test.property, test.op, test.value) for test in filter2.tests]
+    only1, only2 = set(keys1) - set(keys2), set(keys2) - set(keys1)
+    
+    if len(only1) == 1 and len(only2) == 1:
+        (property, op, value), = only1
+        
+        if (property, complement_ops[op], value) in only2:
+            if op in ('=', '!=') or property == 'scale-denominator':
+                return Filter(*[test for (test, key) in zip(filter1.tests, keys1) if key not in only1])
+    
+    others1 = set([key for key in keys1 if key[0] != 'scale-denominator'])
+    others2 = set([key for key in keys2 if key[0] != 'scale-denominator'])
+    
+    if others1 != others2:
+        return None
+    
+    def scale_edges(filter):
+        """ Return lower and upper scale-denominator tests, or None.
+        """
+        lowers = [test for test in filter.tests if test.isMapScaled() and test.op in ('>', '>=')]
+        uppers = [test for test in filter.tests if test.isMapScaled() and test.op in ('<', '<=')]
+        scaled = [test for test in filter.tests if test.isMapScaled()]
+        
+        if len(lowers) > 1 or len(uppers) > 1 or len(lowers) + len(uppers) != len(scaled):
+            return None
+        
+        return (lowers and lowers[0] or None), (uppers and uppers[0] or None)
+    
+    edges1, edges2 = scale_edges(filter1), scale_edges(filter2)
+    
+    if edges1 is None or edges2 is None:
+        return None
+    
+    for ((lower1, upper1), (lower2, upper2)) in ((edges1, edges2), (edges2, edges1)):
+        if upper1 is None or lower2 is None:
+            continue
+        
+        if (upper1.op, upper1.value) != (complement_ops[lower2.op], lower2.value):
+            continue
+        
+        tests = [test for test in filter1.tests if not test.isMapScaled()]
+        tests = [test for test in (lower1, upper2) if test] + tests
+        
+        return Filter(*tests)
+    
+    return None
+
+def rule_values_key(rule):
+    """ Return a hashable key for a dictionary of property values.
+    
+        Rules with equal keys make identical symbolizers.
+    """
+    return tuple(sorted([(name, value.value.__class__, repr(value.value))
+                         for (name, value) in rule.items()]))
+
+def filter_signatures(filter):
+    """ Return a list of (signature, partner) pairs for a Filter.
+    
+        Any Filter that coalesced_filter() could merge with this one has
+        a signature equal to one of the partners here.
+    """
+    keys = sorted([(test.property, test.op, test.value) for test in filter.tests])
+    signatures = []
+    
+    for (i, (property, op, value)) in enumerate(keys):
+        if op in ('=', '!=') or property == 'scale-denominator':
+            rest = tuple(keys[:i] + keys[i+1:])
+            signatures.append((('not', rest, property, op, value),
+                               ('not', rest, property, complement_ops[op], value)))
+    
+    others = tuple([key for key in keys if key[0] != 'scale-denominator'])
+    
+    for (property, op, value) in keys:
+        if property == 'scale-denominator' and op in ('<', '<='):
+            signatures.append((('upper', others, op, value),
+                               ('lower', others, complement_ops[op], value)))
+
+        elif property == 'scale-denominator' and op in ('>', '>='):
+            signatures.append((('lower', others, op, value),
+                               ('upper', others, complement_ops[op], value)))
+    
+    return signatures
+
+def coalesce_rules(rules):
+    """ Given a list of (filter, rule) pairs from a cascade, merge pairs with
+        identical values and complementary filters, until none are left.
+    
+        Filters from a cascade never overlap, so merged filters don't either,
+        and the rules can be put in any order. Mapnik checks every rule of a
+        style against every feature, so fewer rules means faster rendering.
+    """
+    # filter, rule, values key and signatures for each pair
+    entries = [(filter, rule, rule_values_key(rule), filter_signatures(filter))
+               for (filter, rule) in rules]
+    merged = True
+    
+    while merged:
+        merged = False
+        
+        # earlier entries by signature, and ones already merged in this pass
+        signed, changed = {}, set()
+        
+        for (i, (filter, rule, key, signatures)) in enumerate(entries):
+            for (signature, partner) in signatures:
+                j = signed.get((key, partner))
+                
+                if j is None or j in changed:
+                    continue
+                
+                coalesced = coalesced_filter(entries[j][0], filter)
+                
+                if coalesced is not None:
+                    entries[i] = None
+                    entries[j] = (coalesced, entries[j][1], key, filter_signatures(coalesced))
+                    changed.add(j)
+                    merged = True
+                    break
+            
+            else:
+                for (signature, partner) in signatures:
+                    signed.setdefault((key, signature), i)
+        
+        entries = [entry for entry in entries if entry is not None]
+    
+    return [(filter, rule) for (filter, rule, key, signatures) in entries]
+
+def scale_window(zooms=None, scales=None, scale=1):
+    """ Return a Filter of scale-denominator tests for a window of zoom levels
+        and/or scale denominators, or None if there's no window at all.
+    
+        Zooms and scales are each an optional (min, max) pair, and either end
+        of a pair can be None. Both ends are inclusive. Zoom levels mean the
+        same thing as [zoom] in a stylesheet, and are divided by scale in the
+        same way. Scale denominators are used exactly as given.
+    """
+    tests = []
+    
+    if zooms is not None:
+        minzoom, maxzoom = zooms
+        
+        for zoom in (minzoom, maxzoom):
+            if zoom is not None and zoom not in style.zoom_scale_denominators:
+                raise Exception('Unknown zoom level "%s"' % zoom)
+        
+        if maxzoom is not None:
+            tests.append(style.SelectorAttributeTest('scale-denominator', '>=', min(style.zoom_scale_denominators[maxzoom]) / scale))
+        
+        if minzoom is not None:
+            tests.append(style.SelectorAttributeTest('scale-denominator', '<', max(style.zoom_scale_denominators[minzoom]) / scale))
+    
+    if scales is not None:
+        minscale, maxscale = scales
+        
+        if minscale is not None:
+            tests.append(style.SelectorAttributeTest('scale-denominator', '>=', minscale))
+        
+        if maxscale is not None:
+            tests.append(style.SelectorAttributeTest('scale-denominator', '<=', maxscale))
+    
+    return tests and Filter(*tests) or None
+
+def clipped_filter(filter, window):
+    """ Return a Filter narrowed down to a window from scale_window(),
+        or None if there's nothing left of it inside the window.
+    """
+    is_ranged = lambda test: test.isMapScaled() and test.op in ('<', '<=', '>', '>=')
+    
+    ranged = [test for test in filter.tests + window.tests if is_ranged(test)]
+    tests = [test for test in filter.tests if not is_ranged(test)]
+    lower, upper = None, None
+    
+    # keep the tightest bound on each side
+    for test in ranged:
+        if test.op in ('>', '>='):
+            if lower is None or (test.value, test.op == '>') > (lower.value, lower.op == '>'):
+                lower = test
+
+        elif upper is None or (test.value, test.op != '<') < (upper.value, upper.op != '<'):
+            upper = test
+    
+    if lower is not None and upper is not None:
+        if lower.value > upper.value:
+            return None
+        
+        if lower.value == upper.value and (lower.op == '>' or upper.op == '<'):
+            return None
+    
+    return Filter(*([test for test in (lower, upper) if test] + tests))
+
+def clip_rules(rules, window):
+    """ Given a list of (filter, rule) pairs, return those that can be seen
+        inside a window from scale_window(), with filters clipped to it.
+    """
+    clipped = [(clipped_filter(filter, window), rule) for (filter, rule) in rules]
+    
+    return [(filter, rule) for (filter, rule) in clipped if filter is not None]
+
+def get_polygon_rules(declarations, context=None):
     """ Given a Map element, a Layer element, and a list of declarations,
         create a new Style element with a PolygonSymbolizer, add it to Map
         and refer to it in Layer.
@@ -855,7 +1499,7 @@ def get_polygon_rules(declarations):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
         color = values.has_key('polygon-fill') and values['polygon-fill'].value
         opacity = values.has_key('polygon-opacity') and values['polygon-opacity'].value or None
         gamma = values.has_key('polygon-gamma') and values['polygon-gamma'].value or None
@@ -866,7 +1510,7 @@ def get_polygon_rules(declarations):
     
     return rules
 
-def get_raster_rules(declarations):
+def get_raster_rules(declarations, context=None):
     """ Given a Map element, a Layer element, and a list of declarations,
         create a new Style element with a RasterSymbolizer, add it to Map
         and refer to it in Layer.
@@ -884,7 +1528,7 @@ def get_raster_rules(declarations):
     # a place to put rules
     rules = []
 
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
         sym_params = {}
         for prop,attr in property_map.items():
             sym_params[attr] = values.has_key(prop) and values[prop].value or None
@@ -895,11 +1539,12 @@ def get_raster_rules(declarations):
 
     if not rules:
         # No raster-* rules were created, but we're here so we must need a symbolizer.
-        rules.append(make_rule(Filter(), output.RasterSymbolizer()))
+        window = context and context.window
+        rules.append(make_rule(window and window.clone() or Filter(), output.RasterSymbolizer()))
     
     return rules
 
-def get_line_rules(declarations):
+def get_line_rules(declarations, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         This function is wise to line-<foo>, inline-<foo>, and outline-<foo> properties,
@@ -921,7 +1566,7 @@ def get_line_rules(declarations):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         width = values.has_key('line-width') and values['line-width'].value
         color = values.has_key('line-color') and values['line-color'].value
@@ -960,7 +1605,7 @@ def get_line_rules(declarations):
 
     return rules
 
-def get_text_rule_groups(declarations):
+def get_text_rule_groups(declarations, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
     """
     property_map = {'text-anchor-dx': 'anchor_dx', # does nothing
@@ -1018,7 +1663,7 @@ def get_text_rule_groups(declarations):
         # a place to put rules
         rules = []
         
-        for (filter, values) in filtered_property_declarations(name_declarations, property_names):
+        for (filter, values) in filtered_property_declarations(name_declarations, property_names, context):
             
             face_name = values.has_key('text-face-name') and values['text-face-name'].value or None
             fontset = values.has_key('text-fontset') and values['text-fontset'].value or None
@@ -1097,10 +1742,8 @@ def locally_cache_remote_file(href, dir):
         
     if resp.status in range(200, 210):
         # hurrah, it worked
-        f = open(un_posix(local_path), 'wb')
         msg('Reading from remote: %s' % remote_path)
-        f.write(resp.read())
-        f.close()
+        replace_file(local_path, lambda file: file.write(resp.read()))
 
     elif resp.status in (301, 302, 303) and resp.getheader('location', False):
         # follow a redirect, totally untested.
@@ -1160,13 +1803,14 @@ def post_process_symbolizer_image_file(file_href, dirs):
     dest_file = un_posix('%s%s' % (image_name, output_ext))
     
     if not posixpath.exists(dest_file):
-        img.save(dest_file,'PNG')
+        # other layers may be doing the same thing in other processes
+        replace_file(dest_file, lambda file: img.save(file, 'PNG'))
 
     msg('Destination file: %s' % dest_file)
 
     return dest_file, output_ext[1:], img.size[0], img.size[1]
 
-def get_shield_rule_groups(declarations, dirs):
+def get_shield_rule_groups(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1206,7 +1850,7 @@ def get_shield_rule_groups(declarations, dirs):
         # a place to put rules
         rules = []
         
-        for (filter, values) in filtered_property_declarations(name_declarations, property_names):
+        for (filter, values) in filtered_property_declarations(name_declarations, property_names, context):
         
             face_name = values.has_key('shield-face-name') and values['shield-face-name'].value or None
             fontset = values.has_key('shield-fontset') and values['shield-fontset'].value or None
@@ -1242,7 +1886,7 @@ def get_shield_rule_groups(declarations, dirs):
     
     return dict(groups)
 
-def get_point_rules(declarations, dirs):
+def get_point_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1257,7 +1901,7 @@ def get_point_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
         point_file, point_type, point_width, point_height \
             = values.has_key('point-file') \
             and post_process_symbolizer_image_file(str(values['point-file'].value), dirs) \
@@ -1274,7 +1918,7 @@ def get_point_rules(declarations, dirs):
     
     return rules
 
-def get_polygon_pattern_rules(declarations, dirs):
+def get_polygon_pattern_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1289,7 +1933,7 @@ def get_polygon_pattern_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         poly_pattern_file, poly_pattern_type, poly_pattern_width, poly_pattern_height \
             = values.has_key('polygon-pattern-file') \
@@ -1305,7 +1949,7 @@ def get_polygon_pattern_rules(declarations, dirs):
     
     return rules
 
-def get_line_pattern_rules(declarations, dirs):
+def get_line_pattern_rules(declarations, dirs, context=None):
     """ Given a list of declarations, return a list of output.Rule objects.
         
         Optionally provide an output directory for local copies of image files.
@@ -1320,7 +1964,7 @@ def get_line_pattern_rules(declarations, dirs):
     # a place to put rules
     rules = []
     
-    for (filter, values) in filtered_property_declarations(declarations, property_names):
+    for (filter, values) in filtered_property_declarations(declarations, property_names, context):
     
         line_pattern_file, line_pattern_type, line_pattern_width, line_pattern_height \
             = values.has_key('line-pattern-file') \
@@ -1336,13 +1980,101 @@ def get_line_pattern_rules(declarations, dirs):
     
     return rules
 
+class DeclarationIndex:
+    """ Declarations indexed by the names their selectors require,
+        for finding the ones that match an element without a linear scan.
+    
+        Each selector's first element is compiled once into a tuple of tags,
+        a tuple of IDs and a frozenset of classes, and its declarations are
+        filed under one required name: an ID if there is one, or else a class,
+        or else a tag. Declarations with only "*" match everything.
+    """
+    def __init__(self, declarations):
+        self.declarations = declarations
+        self.everywhere = []
+        self.named = {}
+        self.requirements = []
+        
+        compiled = {}
+        
+        for (position, dec) in enumerate(declarations):
+            if id(dec.selector) not in compiled:
+                names = dec.selector.elements[0].names
+                tags = tuple([name for name in names if name != '*' and name[0] not in '#.'])
+                ids = tuple([name[1:] for name in names if name.startswith('#')])
+                classes = [name[1:] for name in names if name.startswith('.')]
+                
+                if len(set(classes)) == len(classes):
+                    compiled[id(dec.selector)] = tags, ids, frozenset(classes)
+                else:
+                    # repeated classes have to be matched repeatedly
+                    compiled[id(dec.selector)] = None
+            
+            self.requirements.append(compiled[id(dec.selector)])
+            
+            if compiled[id(dec.selector)] is None:
+                self.everywhere.append(position)
+                continue
+            
+            tags, ids, classes = compiled[id(dec.selector)]
+            
+            if ids:
+                self.named.setdefault('#' + ids[0], []).append(position)
+            elif classes:
+                self.named.setdefault('.' + min(classes), []).append(position)
+            elif tags:
+                self.named.setdefault(tags[0], []).append(position)
+            else:
+                self.everywhere.append(position)
+    
+    def matching(self, tag, id, classes):
+        """ Return declarations that match a tag, ID and list of classes, in order.
+        
+            Same result as filtering with Selector.matches().
+        """
+        class_set = set(classes)
+        positions = self.everywhere[:]
+        
+        for name in [tag, id and ('#' + id)] + ['.' + class_ for class_ in class_set]:
+            positions += self.named.get(name, [])
+        
+        positions.sort()
+        matches = []
+        
+        for position in positions:
+            dec, requirement = self.declarations[position], self.requirements[position]
+            
+            if requirement is None:
+                if dec.selector.matches(tag, id, classes):
+                    matches.append(dec)
+                continue
+            
+            tags, ids, required_classes = requirement
+            
+            if tags and tags != (tag, ):
+                continue
+            
+            if ids and ids != (id, ):
+                continue
+            
+            if required_classes <= class_set:
+                matches.append(dec)
+        
+        return matches
+
 def get_applicable_declarations(element, declarations):
     """ Given an XML element and a list of declarations, return the ones
         that match as a list of (property, value, selector) tuples.
+        
+        Declarations can also be a DeclarationIndex, which is much faster
+        when it's used for more than a few elements.
     """
     element_tag = element.tag
     element_id = element.get('id', None)
     element_classes = element.get('class', '').split()
+    
+    if isinstance(declarations, DeclarationIndex):
+        return declarations.matching(element_tag, element_id, element_classes)
 
     return [dec for dec in declarations
             if dec.selector.matches(element_tag, element_id, element_classes)]
@@ -1448,7 +2180,52 @@ def localize_file_datasource(file_href, dirs):
     else:
         return dirs.output_path(path)
     
-def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_styles=[], scale=1):
+def layer_style_rules(declarations, is_raster, dirs, engine='cartesian', window=None, profile=False):
+    """ Given a layer's applicable declarations, return a list of rules for
+        each of its styles as (kind, text name, rules) tuples, in order,
+        and a Profile of the work if profile is true or None otherwise.
+        
+        Text name is None for styles other than shields and text. Styles are
+        not named here, so that this can be done in a separate process.
+    """
+    # one cascade context shared by all the styles in this layer
+    context = CascadeContext(engine, window)
+    profile = profile and Profile() or None
+    
+    def get_rules(function, *args):
+        if profile is None:
+            return function(*args)
+        
+        return profile.call(function.__name__, function, *args)
+    
+    if is_raster:
+        styles = [('raster', None, get_rules(get_raster_rules, declarations, context))]
+    
+    else:
+        styles = [('polygon', None, get_rules(get_polygon_rules, declarations, context)),
+                  ('polygon pattern', None, get_rules(get_polygon_pattern_rules, declarations, dirs, context)),
+                  ('line', None, get_rules(get_line_rules, declarations, context)),
+                  ('line pattern', None, get_rules(get_line_pattern_rules, declarations, dirs, context))]
+    
+        for (shield_name, shield_rules) in get_rules(get_shield_rule_groups, declarations, dirs, context).items():
+            styles.append(('shield', shield_name, shield_rules))
+    
+        for (text_name, text_rules) in get_rules(get_text_rule_groups, declarations, context).items():
+            styles.append(('text', text_name, text_rules))
+    
+        styles.append(('point', None, get_rules(get_point_rules, declarations, dirs, context)))
+    
+    if profile is not None:
+        profile.combinations, profile.kept = context.combinations, context.kept
+    
+    return styles, profile
+
+def _layer_style_rules(args):
+    """ Single-argument layer_style_rules() for multiprocessing.Pool.map().
+    """
+    return layer_style_rules(*args)
+
+def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_styles=[], scale=1, engine='cartesian', workers=1, zooms=None, scales=None, profile=False):
     """ Compile a Cascadenik MML file, returning a cascadenik.output.Map object.
     
         Parameters:
@@ -1483,141 +2260,285 @@ def compile(src, dirs, verbose=False, srs=None, datasources_cfg=None, user_style
         
           scale:
             Scale value for output map, 2 doubles the size for high-res displays.
+        
+          engine:
+            Name of the cascade engine used to turn declarations into rules,
+            "cartesian" (default) or "diagram". Both produce the same rules,
+            but "diagram" is much faster for layers with many attribute tests.
+        
+          workers:
+            Number of processes for parsing stylesheets and compiling layer
+            styles, default 1. Style names and output are the same for any
+            number of workers.
+        
+          zooms:
+            Optional (min, max) pair of zoom levels to compile for, inclusive.
+            Either can be None. Needs a spherical mercator map, like [zoom].
+        
+          scales:
+            Optional (min, max) pair of scale denominators to compile for,
+            inclusive. Either can be None.
+        
+            Declarations and layers that can't be seen inside the zooms and
+            scales given are left out, and rules are clipped to fit.
+        
+          profile:
+            If True, the returned map has a Profile in its profile attribute,
+            with wall time and call counts for each phase of the compile and
+            filter combination and rule counts for each layer.
+    """
+    return compile_scaled(src, dirs, [scale], verbose, srs, datasources_cfg, user_styles,
+                          engine, workers, zooms, scales, profile)[0]
+
+def compile_scaled(src, dirs, scale_factors, verbose=False, srs=None, datasources_cfg=None, user_styles=[], engine='cartesian', workers=1, zooms=None, scales=None, profile=False):
+    """ Compile a Cascadenik MML file once for each of a list of scale factors,
+        returning a list of cascadenik.output.Map objects in the same order.
+    
+        Stylesheets are parsed and datasources are localized just once,
+        and each scale factor gets scaled copies of the same declarations.
+        Each map is exactly what compile() would return for its scale,
+        and other parameters are the same as for compile(). Each profile
+        has the shared work and the work for its own map.
     """
-    global VERBOSE
+    global VERBOSE, PROFILE
+    
+    if engine not in cascade_engines:
+        raise Exception('Unknown cascade engine "%s"' % engine)
 
     if verbose:
         VERBOSE = True
         sys.stderr.write('\n')
     
-    msg('Targeting mapnik version: %s | %s' % (MAPNIK_VERSION, MAPNIK_VERSION_STR))
-        
-    if posixpath.exists(src):
-        doc = ElementTree.parse(src)
-        map_el = doc.getroot()
-    else:
-        try:
-            # guessing src is a literal XML string?
-            map_el = ElementTree.fromstring(src)
+    PROFILE = profile and Profile() or None
     
-        except:
-            if not (src[:7] in ('http://', 'https:/', 'file://')):
-                src = "file://" + src
-            try:
-                doc = ElementTree.parse(urllib.urlopen(src))
-            except IOError, e:
-                raise IOError('%s: %s' % (e,src))
+    try:
+        msg('Targeting mapnik version: %s | %s' % (MAPNIK_VERSION, MAPNIK_VERSION_STR))
+            
+        if posixpath.exists(src):
+            doc = ElementTree.parse(src)
             map_el = doc.getroot()
-
-    expand_source_declarations(map_el, dirs, datasources_cfg)
-    declarations = extract_declarations(map_el, dirs, scale, user_styles)
-    
-    # a list of layers and a sequential ID generator
-    layers, ids = [], (i for i in xrange(1, 999999))
-
-
-    # Handle base datasources
-    # http://trac.mapnik.org/changeset/574
-    datasource_templates = {}
-    for base_el in map_el:
-        if base_el.tag != 'Datasource':
-            continue
-        datasource_templates[base_el.get('name')] = dict(((p.get('name'),p.text) for p in base_el.findall('Parameter')))
-    
-    for layer_el in map_el.findall('Layer'):
-    
-        # nevermind with this one
-        if layer_el.get('status', None) in ('off', '0', 0):
-            continue
-
-        # build up a map of Parameters for this Layer
-        datasource_params = dict((p.get('name'),p.text) for p in layer_el.find('Datasource').findall('Parameter'))
-
-        base = layer_el.find('Datasource').get('base')
-        if base:
-            datasource_params.update(datasource_templates[base])
-
-        if datasource_params.get('table'):
-            # remove line breaks from possible SQL, using a possibly-unsafe regexp
-            # that simply blows away anything that looks like it might be a SQL comment.
-            # http://trac.mapnik.org/ticket/173
-            if not MAPNIK_VERSION >= 601:
-                sql = datasource_params.get('table')
-                sql = compile(r'--.*$', MULTILINE).sub('', sql)
-                sql = sql.replace('\r', ' ').replace('\n', ' ')
-                datasource_params['table'] = sql
-
-        elif datasource_params.get('file') is not None:
-            # make sure we localize any remote files
-            file_param = datasource_params.get('file')
-
-            if datasource_params.get('type') == 'shape':
-                # handle a local shapefile or fetch a remote, zipped shapefile
-                msg('Handling shapefile datasource...')
-                file_param = localize_shapefile(file_param, dirs)
-
-                # TODO - support datasource reprojection to make map srs
-                # TODO - support automatically indexing shapefiles
-
-            else: # ogr,raster, gdal, sqlite
-                # attempt to generically handle other file based datasources
-                msg('Handling generic datasource...')
-                file_param = localize_file_datasource(file_param, dirs)
-
-            msg("Localized path = %s" % un_posix(file_param))
-            datasource_params['file'] = un_posix(file_param)
-
-            # TODO - consider custom support for other mapnik datasources:
-            # sqlite, oracle, osm, kismet, gdal, raster, rasterlite
-
-        layer_declarations = get_applicable_declarations(layer_el, declarations)
-        
-        # a list of styles
-        styles = []
-        
-        if datasource_params.get('type', None) == 'gdal':
-            styles.append(output.Style('raster style %d' % ids.next(),
-                                       get_raster_rules(layer_declarations)))
-    
         else:
-            styles.append(output.Style('polygon style %d' % ids.next(),
-                                       get_polygon_rules(layer_declarations)))
-    
-            styles.append(output.Style('polygon pattern style %d' % ids.next(),
-                                       get_polygon_pattern_rules(layer_declarations, dirs)))
-    
-            styles.append(output.Style('line style %d' % ids.next(),
-                                       get_line_rules(layer_declarations)))
-    
-            styles.append(output.Style('line pattern style %d' % ids.next(),
-                                       get_line_pattern_rules(layer_declarations, dirs)))
-    
-            for (shield_name, shield_rules) in get_shield_rule_groups(layer_declarations, dirs).items():
-                styles.append(output.Style('shield style %d (%s)' % (ids.next(), shield_name), shield_rules))
-    
-            for (text_name, text_rules) in get_text_rule_groups(layer_declarations).items():
-                styles.append(output.Style('text style %d (%s)' % (ids.next(), text_name), text_rules))
-    
-            styles.append(output.Style('point style %d' % ids.next(),
-                                       get_point_rules(layer_declarations, dirs)))
-                                   
-        styles = [s for s in styles if s.rules]
+            try:
+                # guessing src is a literal XML string?
+                map_el = ElementTree.fromstring(src)
         
-        if styles:
-            datasource = output.Datasource(**datasource_params)
+            except:
+                if not (src[:7] in ('http://', 'https:/', 'file://')):
+                    src = "file://" + src
+                try:
+                    doc = ElementTree.parse(urllib.urlopen(src))
+                except IOError, e:
+                    raise IOError('%s: %s' % (e,src))
+                map_el = doc.getroot()
+
+        profiled('expand_source_declarations', expand_source_declarations, map_el, dirs, datasources_cfg)
+        unscaled_declarations = extract_declarations(map_el, dirs, 1, user_styles, workers)
+        
+        if zooms is not None and not is_merc_projection(map_el.get('srs', '')):
+            raise NotImplementedError('Map srs is not web mercator, so zoom levels cannot be properly converted to scale denominators')
+        
+        # Handle base datasources
+        # http://trac.mapnik.org/changeset/574
+        datasource_templates = {}
+        for base_el in map_el:
+            if base_el.tag != 'Datasource':
+                continue
+            datasource_templates[base_el.get('name')] = dict(((p.get('name'),p.text) for p in base_el.findall('Parameter')))
+        
+        layer_els = map_el.findall('Layer')
+        
+        # layer datasource parameters, keyed on layer index
+        localized_params = {}
+        
+        def localized_datasource_params(layer_el):
+            """ Return a dictionary of Datasource parameters for a Layer, with any
+                remote files fetched. Done once per layer, whatever the scale.
+            """
+            # build up a map of Parameters for this Layer
+            datasource_params = dict((p.get('name'),p.text) for p in layer_el.find('Datasource').findall('Parameter'))
+
+            base = layer_el.find('Datasource').get('base')
+            if base:
+                datasource_params.update(datasource_templates[base])
+
+            if datasource_params.get('table'):
+                # remove line breaks from possible SQL, using a possibly-unsafe regexp
+                # that simply blows away anything that looks like it might be a SQL comment.
+                # http://trac.mapnik.org/ticket/173
+                if not MAPNIK_VERSION >= 601:
+                    sql = datasource_params.get('table')
+                    sql = compile(r'--.*$', MULTILINE).sub('', sql)
+                    sql = sql.replace('\r', ' ').replace('\n', ' ')
+                    datasource_params['table'] = sql
+
+            elif datasource_params.get('file') is not None:
+                # make sure we localize any remote files
+                file_param = datasource_params.get('file')
+
+                if datasource_params.get('type') == 'shape':
+                    # handle a local shapefile or fetch a remote, zipped shapefile
+                    msg('Handling shapefile datasource...')
+                    file_param = profiled('localize_shapefile', localize_shapefile, file_param, dirs)
+
+                    # TODO - support datasource reprojection to make map srs
+                    # TODO - support automatically indexing shapefiles
+
+                else: # ogr,raster, gdal, sqlite
+                    # attempt to generically handle other file based datasources
+                    msg('Handling generic datasource...')
+                    file_param = profiled('localize_file_datasource', localize_file_datasource, file_param, dirs)
+
+                msg("Localized path = %s" % un_posix(file_param))
+                datasource_params['file'] = un_posix(file_param)
+
+                # TODO - consider custom support for other mapnik datasources:
+                # sqlite, oracle, osm, kismet, gdal, raster, rasterlite
             
-            layer = output.Layer('layer %d' % ids.next(),
-                                 datasource, styles,
-                                 layer_el.get('srs', None),
-                                 layer_el.get('min_zoom', None) and int(layer_el.get('min_zoom')) or None,
-                                 layer_el.get('max_zoom', None) and int(layer_el.get('max_zoom')) or None)
-    
-            layers.append(layer)
-    
-    map_attrs = get_map_attributes(get_applicable_declarations(map_el, declarations))
-    
-    # if a target srs is profiled, override whatever is in mml
-    if srs is not None:
-        map_el.set('srs', srs)
+            return datasource_params
+        
+        def scaled_map(scale):
+            """ Return a complete output.Map for one scale factor.
+            """
+            if scale == 1:
+                declarations = unscaled_declarations
+            else:
+                declarations = [dec.scaledBy(scale) for dec in unscaled_declarations]
+            
+            window = scale_window(zooms, scales, scale)
+            
+            if window is not None:
+                # nothing outside the window matters
+                declarations = [dec for dec in declarations if is_applicable_selector(dec.selector, window)]
+            
+            declaration_index = DeclarationIndex(declarations)
+            
+            # cascade and rule work is different for each scale factor
+            map_profile = profile and Profile() or None
+            
+            # a list of layers and a sequential ID generator
+            layers, ids = [], (i for i in xrange(1, 999999))
+            
+            # layers to output, and styles to compute keyed on layer fingerprints
+            layer_jobs, style_jobs, fingerprints = [], [], {}
+            
+            for (index, layer_el) in enumerate(layer_els):
+            
+                # nevermind with this one
+                if layer_el.get('status', None) in ('off', '0', 0):
+                    continue
+
+                if window is not None:
+                    # layer min_zoom and max_zoom are really scale denominators
+                    layer_tests = []
+                
+                    if layer_el.get('min_zoom', None):
+                        layer_tests.append(style.SelectorAttributeTest('scale-denominator', '>=', int(layer_el.get('min_zoom'))))
+                
+                    if layer_el.get('max_zoom', None):
+                        layer_tests.append(style.SelectorAttributeTest('scale-denominator', '<=', int(layer_el.get('max_zoom'))))
+                
+                    # or this one, it can't be seen in the window
+                    if clipped_filter(Filter(*layer_tests), window) is None:
+                        continue
+
+                if index not in localized_params:
+                    localized_params[index] = localized_datasource_params(layer_el)
+            
+                datasource_params = localized_params[index]
+            
+                layer_declarations = get_applicable_declarations(layer_el, declaration_index)
+            
+                #
+                # Layers that match exactly the same declarations end up with exactly
+                # the same styles, so those are made once and shared between them.
+                #
+                fingerprint = datasource_params.get('type', None), tuple([id(dec) for dec in layer_declarations])
+            
+                if fingerprint not in fingerprints:
+                    fingerprints[fingerprint] = len(style_jobs)
+                    is_raster = datasource_params.get('type', None) == 'gdal'
+                    style_jobs.append((layer_declarations, is_raster, dirs, engine, window, profile))
+            
+                layer_jobs.append((layer_el, datasource_params, fingerprint))
+            
+            if workers > 1 and len(style_jobs) > 1:
+                msg('Compiling %d layer styles with %d workers' % (len(style_jobs), workers))
+                pool = multiprocessing.Pool(workers)
+            
+                try:
+                    style_rules = pool.map(_layer_style_rules, style_jobs)
+                finally:
+                    pool.terminate()
+            
+            else:
+                style_rules = map(_layer_style_rules, style_jobs)
+            
+            # styles already made, keyed on layer fingerprints
+            layer_styles = {}
+            
+            #
+            # Name styles and layers in document order, exactly as if each
+            # layer had been compiled in turn, regardless of who did the work.
+            #
+            for (layer_el, datasource_params, fingerprint) in layer_jobs:
+                layer_rules, layer_profile = style_rules[fingerprints[fingerprint]]
+                reused = fingerprint in layer_styles
+            
+                if not reused:
+                    styles = []
+                
+                    if layer_profile is not None:
+                        map_profile.merge(layer_profile)
+                
+                    for (kind, text_name, rules) in layer_rules:
+                        if text_name is None:
+                            styles.append(output.Style('%s style %d' % (kind, ids.next()), rules))
+                        else:
+                            styles.append(output.Style('%s style %d (%s)' % (kind, ids.next(), text_name), rules))
+                
+                    layer_styles[fingerprint] = [s for s in styles if s.rules]
+            
+                styles = layer_styles[fingerprint]
+            
+                if styles:
+                    datasource = output.Datasource(**datasource_params)
+                
+                    layer = output.Layer('layer %d' % ids.next(),
+                                         datasource, styles[:],
+                                         layer_el.get('srs', None),
+                                         layer_el.get('min_zoom', None) and int(layer_el.get('min_zoom')) or None,
+                                         layer_el.get('max_zoom', None) and int(layer_el.get('max_zoom')) or None)
+            
+                    layers.append(layer)
+            
+                if layer_profile is not None:
+                    names = ['#' + layer_el.get('id')] if layer_el.get('id') else []
+                    names += ['.' + name for name in layer_el.get('class', '').split()]
+                    
+                    # reused styles were cascaded for an earlier layer, so count no work here
+                    combinations, kept = reused and (0, 0) or (layer_profile.combinations, layer_profile.kept)
+                
+                    map_profile.addLayer(' '.join(names) or '(layer)', combinations,
+                                         kept, sum([len(style.rules) for style in styles]))
+            
+            map_attrs = get_map_attributes(get_applicable_declarations(map_el, declaration_index))
+            
+            # if a target srs is profiled, override whatever is in mml
+            if srs is not None:
+                map_el.set('srs', srs)
+            
+            output_map = output.Map(map_el.attrib.get('srs', None), layers, **map_attrs)
+            
+            if map_profile is not None:
+                # parsing and localizing are shared by every scale factor
+                map_profile.merge(PROFILE)
+            
+            output_map.profile = map_profile
+            
+            return output_map
+
+        return map(scaled_map, scale_factors)
     
-    return output.Map(map_el.attrib.get('srs', None), layers, **map_attrs)
+    finally:
+        # never leave a profile behind for the next compile
+        PROFILE = None
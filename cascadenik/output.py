@@ -45,8 +45,15 @@ class Map:
             ids = count(1)
             fontsets = dict()
             
+            # styles shared by several layers only need to be added once
+            style_names = set()
+            
             for layer in self.layers:
                 for style in layer.styles:
+                    if style.name in style_names:
+                        continue
+                    
+                    style_names.add(style.name)
     
                     sty = mapnik.Style()
                     
@@ -1,13 +1,13 @@
 import re
-import operator
-from copy import deepcopy
+import heapq
+import cPickle
 from itertools import chain, product
 from binascii import unhexlify as unhex
-from cssutils.tokenize2 import Tokenizer as cssTokenizer
 
 from .style import properties, numbers, strings, boolean, uri, color, color_transparent
 from .style import Selector, SelectorElement, ConcatenatedElement, SelectorAttributeTest
 from .style import Declaration, Property, Value
+from .tokenizer import Tokenizer
 
 class ParseException(Exception):
     """ Exception raised when a parsing error is encountered.
@@ -28,35 +28,277 @@ class BlockTerminatedValue (Exception):
         self.line = line
         self.col = col
 
-def stylesheet_declarations(string, is_merc=False, scale=1):
+class Variable:
+    """ Value tokens for an @variable, as they appear where it's defined.
+    
+        Tokens are complete (name, value, line, col) tuples, and may refer
+        to other variables. Those are looked up where this one is used, so
+        a variable can refer to one defined after it, and sees redefinitions.
+        Resolved tokens are remembered for as long as every variable they
+        came from stays the same.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.references = [tvalue for (tname, tvalue, line, col) in tokens if tname == 'ATKEYWORD']
+        self.memo = None
+        
+        if not self.references:
+            self.memo = (), Resolved(tokens)
+    
+    def resolve(self, variables, line, col, using=()):
+        """ Return a Resolved with other variables substituted as defined now.
+        
+            Line and column are those of the use, for errors.
+        """
+        if not self.references:
+            return self.memo[1]
+        
+        if self in using:
+            raise ParseException('Circular variable definition', line, col)
+        
+        resolved = []
+        
+        for name in self.references:
+            if name not in variables:
+                raise ParseException('Undefined variable "%s"' % name, line, col)
+            
+            resolved.append(variables[name].resolve(variables, line, col, using + (self, )))
+        
+        if self.memo is None or len(self.memo[0]) != len(resolved) \
+        or False in [a is b for (a, b) in zip(self.memo[0], resolved)]:
+            tokens, parts = [], iter(resolved)
+            
+            for token in self.tokens:
+                if token[0] == 'ATKEYWORD':
+                    tokens += parts.next().tokens
+                else:
+                    tokens.append(token)
+            
+            self.memo = tuple(resolved), Resolved(tokens)
+        
+        return self.memo[1]
+
+class Resolved:
+    """ Value tokens for an @variable with no other variables left in them.
+    
+        Values are the (name, value) pairs that parse_value() collects.
+        Inline is false for the rare variable that can end a value or make
+        it !important, which must be fed back through parse_value() instead.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.values = [token[:2] for token in tokens]
+        self.inline = ('CHAR', '!') not in self.values and ('CHAR', '}') not in self.values
+
+class RulesetMismatch (Exception):
+    """ Exception generated when a rule set doesn't end where it was expected to.
+    
+        Caught and handled in iter_stylesheet_declarations(), which starts
+        over without a RulesetCache.
+    """
+    pass
+
+class RulesetCache:
+    """ Declarations parsed from each top-level rule set of a stylesheet,
+        kept for reuse when the same stylesheet is parsed again after an edit.
+    
+        Each rule set is fingerprinted by its tokens, the values of any
+        variables it uses, is_merc and scale. Only rule sets with a new
+        fingerprint are parsed, others have their declarations and variable
+        definitions copied from the previous parse and moved to their new
+        lines and columns. Only the rule sets from the latest parse are kept.
+    """
+    def __init__(self):
+        self.entries = {}
+    
+    def rulesets(self, tokens, variables, is_merc, scale):
+        """ Generate a list of declarations for each top-level rule set.
+        
+            Variables are updated with any definitions along the way,
+            like parse_rule() does.
+        """
+        entries = {}
+        
+        for (chunk, closed) in split_rulesets(tokens):
+            used = [(tvalue, variable_values(tvalue, variables))
+                    for (tname, tvalue, line, col) in chunk if tname == 'ATKEYWORD']
+            
+            fingerprint = (bool(is_merc), scale, tuple([token[:2] for token in chunk]), tuple(used))
+            start = chunk[0][2:]
+            
+            if fingerprint in self.entries:
+                data, old_start = self.entries[fingerprint]
+                ruleset, defined = cPickle.loads(data)
+                
+                move = position_mover(old_start, start)
+                
+                for declaration in ruleset:
+                    importance, specificity, position = declaration.sort_key
+                    declaration.sort_key = importance, specificity, move(*position)
+                
+                for (name, variable) in defined.items():
+                    variables[name] = Variable([(tname, tvalue) + move(line, col)
+                                                for (tname, tvalue, line, col) in variable.tokens])
+            
+            else:
+                previous = variables.copy()
+                ruleset = parse_chunk(chunk, closed, variables, is_merc, scale)
+                defined = dict([(name, variable) for (name, variable) in variables.items()
+                                if previous.get(name) is not variable])
+                
+                data, old_start = cPickle.dumps((ruleset, defined), cPickle.HIGHEST_PROTOCOL), start
+            
+            # positions in data are always relative to old_start
+            entries[fingerprint] = data, old_start
+            yield ruleset
+        
+        self.entries = entries
+
+def variable_values(name, variables):
+    """ Return a tuple of the current values of a variable, or None if it has none.
+    """
+    try:
+        return tuple(variables[name].resolve(variables, 0, 0).values)
+    except (KeyError, ParseException):
+        return None
+
+def split_rulesets(tokens):
+    """ Generate (tokens, closed) pairs for each top-level rule set.
+    
+        Each list of tokens ends with a right-brace that closes a block, and
+        includes any comments, space and variable definitions before it.
+        Closed is false for the last list if it's not ended by a right-brace.
+    """
+    chunk, depth = [], 0
+    
+    for token in tokens:
+        chunk.append(token)
+        
+        if token[0] != 'CHAR':
+            continue
+        
+        if token[1] == '{':
+            depth += 1
+        
+        elif token[1] == '}':
+            depth -= 1
+            
+            if depth <= 0:
+                yield chunk, True
+                chunk, depth = [], 0
+    
+    if chunk:
+        yield chunk, False
+
+def parse_chunk(chunk, closed, variables, is_merc, scale):
+    """ Parse one top-level rule set from split_rulesets(), return a list of declarations.
+    
+        Raise RulesetMismatch if parse_rule() wants more or fewer tokens.
+    """
+    tokens = iter(chunk)
+    
+    try:
+        ruleset = parse_rule(tokens, variables, [], [], is_merc)
+    except StopIteration:
+        if closed:
+            raise RulesetMismatch()
+        return []
+    
+    for token in tokens:
+        raise RulesetMismatch()
+    
+    for declaration in ruleset:
+        if scale != 1:
+            declaration.scaleBy(scale)
+    
+    return ruleset
+
+def position_mover(old_start, new_start):
+    """ Return a function that moves a (line, col) position of a reused token.
+    
+        Everything moves by the same number of lines, and positions on
+        the first line of a rule set also move by the change in column.
+    """
+    (old_line, old_col), (new_line, new_col) = old_start, new_start
+    
+    def move(line, col):
+        if line == old_line:
+            return new_line, col + new_col - old_col
+        
+        return line + new_line - old_line, col
+    
+    return move
+
+def stylesheet_declarations(string, is_merc=False, scale=1, tokenizer=Tokenizer, cache=None):
     """ Parse a string representing a stylesheet into a list of declarations.
     
         Required boolean is_merc indicates whether the projection should
         be interpreted as spherical mercator, so we know what to do with
         zoom/scale-denominator in parse_rule().
+        
+        Optional tokenizer is a class with a tokenize() method, such as
+        cssutils.tokenize2.Tokenizer; by default the faster equivalent
+        in cascadenik.tokenizer is used.
+        
+        Optional cache is a RulesetCache, to reuse the declarations of
+        rule sets that haven't changed since the last time it was used.
+    """
+    return list(iter_stylesheet_declarations(string, is_merc, scale, tokenizer, cache))
+
+def iter_stylesheet_declarations(string, is_merc=False, scale=1, tokenizer=Tokenizer, cache=None):
+    """ Generate the same declarations as stylesheet_declarations(), in order.
+    
+        Each top-level rule set is sorted on its own as it's parsed, and
+        the sorted rule sets are merged on a heap. Ties go to whichever
+        declaration was parsed first, just like a stable sort of the list.
     """
     # everything is display: map by default
     display_map = Declaration(Selector(SelectorElement(['*'], [])),
                               Property('display'), Value('map', False),
                               (False, (0, 0, 0), (0, 0)))
     
-    declarations = [display_map]
+    rulesets = [[(display_map.sort_key, 0, display_map)]]
+    count = 1
 
-    tokens = cssTokenizer().tokenize(string)
+    tokens = tokenizer().tokenize(string)
     variables = {}
     
+    if cache is not None:
+        try:
+            parsed = list(cache.rulesets(tokens, variables, is_merc, scale))
+        except RulesetMismatch:
+            # an odd stylesheet, e.g. with braces in a variable; start over.
+            cache.entries = {}
+            tokens = tokenizer().tokenize(string)
+            variables = {}
+            parsed = iter_rulesets(tokens, variables, is_merc, scale)
+    
+    else:
+        parsed = iter_rulesets(tokens, variables, is_merc, scale)
+    
+    for ruleset in parsed:
+        # sort by a css-like method
+        rulesets.append(sorted([(declaration.sort_key, count + i, declaration)
+                                for (i, declaration) in enumerate(ruleset)]))
+        count += len(ruleset)
+    
+    for (sort_key, index, declaration) in heapq.merge(*rulesets):
+        yield declaration
+
+def iter_rulesets(tokens, variables, is_merc, scale):
+    """ Generate a list of declarations for each top-level rule set.
+    """
     while True:
         try:
-            for declaration in parse_rule(tokens, variables, [], [], is_merc):
-                if scale != 1:
-                    declaration.scaleBy(scale)
-            
-                declarations.append(declaration)
+            ruleset = parse_rule(tokens, variables, [], [], is_merc)
         except StopIteration:
             break
-    
-    # sort by a css-like method
-    return sorted(declarations, key=operator.attrgetter('sort_key'))
+        
+        for declaration in ruleset:
+            if scale != 1:
+                declaration.scaleBy(scale)
+        
+        yield ruleset
 
 def parse_attribute(tokens, is_merc):
     """ Parse a token stream from inside an attribute selector.
@@ -180,6 +422,8 @@ def postprocess_value(property, tokens, important, line, col):
     
         Values can be numbers, strings, colors, uris, or booleans:
         http://www.w3.org/TR/CSS2/syndata.html#values
+        
+        Each kind of value in style.properties has a parser in value_parsers.
     """
     #
     # Helper function.
@@ -218,141 +462,176 @@ def postprocess_value(property, tokens, important, line, col):
     #
     
     tokens = combine_negative_numbers(tokens, line, col)
+    kind = properties[property.name]
+    
+    if type(kind) is tuple:
+        parser = value_parsers[tuple]
+    else:
+        parser = value_parsers[kind]
     
-    if properties[property.name] in (int, float, str, color, uri, boolean) or type(properties[property.name]) is tuple:
+    if parser in single_value_parsers:
         if len(tokens) != 1:
             raise ParseException('Single value only for property "%(property)s"' % locals(), line, col)
 
-    if properties[property.name] is int:
-        if tokens[0][0] != 'NUMBER':
-            raise ParseException('Number value only for property "%(property)s"' % locals(), line, col)
+    value = parser(property, kind, tokens, line, col)
 
-        value = int(tokens[0][1])
+    return Value(value, important)
 
-    elif properties[property.name] is float:
-        if tokens[0][0] != 'NUMBER':
-            raise ParseException('Number value only for property "%(property)s"' % locals(), line, col)
+hex_color_pattern = re.compile(r'^#([0-9a-f]{3}){1,2}$', re.I)
 
-        value = float(tokens[0][1])
+# Colors, booleans and identifiers are parsed once per distinct value,
+# and shared by every declaration with that value. Nothing modifies them.
+color_values = {}
+boolean_values = {'true': boolean(True), 'false': boolean(False)}
+identifier_values = {}
 
-    elif properties[property.name] is str:
-        if tokens[0][0] != 'STRING':
-            raise ParseException('String value only for property "%(property)s"' % locals(), line, col)
+def parse_int_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'NUMBER':
+        raise ParseException('Number value only for property "%(property)s"' % locals(), line, col)
 
-        value = str(tokens[0][1][1:-1])
+    return int(tokens[0][1])
 
-    elif properties[property.name] is color_transparent:
-        if tokens[0][0] != 'HASH' and (tokens[0][0] != 'IDENT' or tokens[0][1] != 'transparent'):
-            raise ParseException('Hash or transparent value only for property "%(property)s"' % locals(), line, col)
+def parse_float_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'NUMBER':
+        raise ParseException('Number value only for property "%(property)s"' % locals(), line, col)
 
-        if tokens[0][0] == 'HASH':
-            if not re.match(r'^#([0-9a-f]{3}){1,2}$', tokens[0][1], re.I):
-                raise ParseException('Unrecognized color value for property "%(property)s"' % locals(), line, col)
-    
-            hex = tokens[0][1][1:]
-            
-            if len(hex) == 3:
-                hex = hex[0]+hex[0] + hex[1]+hex[1] + hex[2]+hex[2]
-            
-            rgb = (ord(unhex(h)) for h in (hex[0:2], hex[2:4], hex[4:6]))
-            
-            value = color(*rgb)
+    return float(tokens[0][1])
 
-        else:
-            value = 'transparent'
+def parse_str_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'STRING':
+        raise ParseException('String value only for property "%(property)s"' % locals(), line, col)
 
-    elif properties[property.name] is color:
-        if tokens[0][0] != 'HASH':
-            raise ParseException('Hash value only for property "%(property)s"' % locals(), line, col)
+    return str(tokens[0][1][1:-1])
 
-        if not re.match(r'^#([0-9a-f]{3}){1,2}$', tokens[0][1], re.I):
+def parse_hash_value(property, tokens, line, col):
+    """ Return a color for a HASH token, from color_values if seen before.
+    """
+    hash = tokens[0][1]
+    
+    if hash not in color_values:
+        if not hex_color_pattern.match(hash):
             raise ParseException('Unrecognized color value for property "%(property)s"' % locals(), line, col)
 
-        hex = tokens[0][1][1:]
+        hex = hash[1:]
         
         if len(hex) == 3:
             hex = hex[0]+hex[0] + hex[1]+hex[1] + hex[2]+hex[2]
         
         rgb = (ord(unhex(h)) for h in (hex[0:2], hex[2:4], hex[4:6]))
         
-        value = color(*rgb)
+        color_values[hash] = color(*rgb)
+    
+    return color_values[hash]
 
-    elif properties[property.name] is uri:
-        if tokens[0][0] != 'URI':
-            raise ParseException('URI value only for property "%(property)s"' % locals(), line, col)
+def parse_color_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'HASH':
+        raise ParseException('Hash value only for property "%(property)s"' % locals(), line, col)
 
-        raw = str(tokens[0][1])
+    return parse_hash_value(property, tokens, line, col)
 
-        if raw.startswith('url("') and raw.endswith('")'):
-            raw = raw[5:-2]
-            
-        elif raw.startswith("url('") and raw.endswith("')"):
-            raw = raw[5:-2]
-            
-        elif raw.startswith('url(') and raw.endswith(')'):
-            raw = raw[4:-1]
+def parse_color_transparent_value(property, kind, tokens, line, col):
+    if tokens[0][0] == 'HASH':
+        return parse_hash_value(property, tokens, line, col)
 
-        value = uri(raw)
-            
-    elif properties[property.name] is boolean:
-        if tokens[0][0] != 'IDENT' or tokens[0][1] not in ('true', 'false'):
-            raise ParseException('true/false value only for property "%(property)s"' % locals(), line, col)
+    if tokens[0][0] != 'IDENT' or tokens[0][1] != 'transparent':
+        raise ParseException('Hash or transparent value only for property "%(property)s"' % locals(), line, col)
 
-        value = boolean(tokens[0][1] == 'true')
-            
-    elif type(properties[property.name]) is tuple:
-        if tokens[0][0] != 'IDENT':
-            raise ParseException('Identifier value only for property "%(property)s"' % locals(), line, col)
+    return 'transparent'
 
-        if tokens[0][1] not in properties[property.name]:
-            raise ParseException('Unrecognized value for property "%(property)s"' % locals(), line, col)
+def parse_uri_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'URI':
+        raise ParseException('URI value only for property "%(property)s"' % locals(), line, col)
 
-        value = str(tokens[0][1])
-            
-    elif properties[property.name] is numbers:
-        values = []
+    raw = str(tokens[0][1])
+
+    if raw.startswith('url("') and raw.endswith('")'):
+        raw = raw[5:-2]
         
-        # strip spaces from the list
-        relevant_tokens = [token for token in tokens if token[0] != 'S']
+    elif raw.startswith("url('") and raw.endswith("')"):
+        raw = raw[5:-2]
         
-        for (i, token) in enumerate(relevant_tokens):
-            if (i % 2) == 0 and token[0] == 'NUMBER':
-                try:
-                    value = int(token[1])
-                except ValueError:
-                    value = float(token[1])
+    elif raw.startswith('url(') and raw.endswith(')'):
+        raw = raw[4:-1]
 
-                values.append(value)
+    # not shared like other values: extract_declarations() modifies uris
+    return uri(raw)
 
-            elif (i % 2) == 1 and token[0] == 'CHAR':
-                # fine, it's a comma
-                continue
+def parse_boolean_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'IDENT' or tokens[0][1] not in boolean_values:
+        raise ParseException('true/false value only for property "%(property)s"' % locals(), line, col)
 
-            else:
-                raise ParseException('Value for property "%(property)s" should be a comma-delimited list of numbers' % locals(), line, col)
+    return boolean_values[tokens[0][1]]
+
+def parse_identifier_value(property, kind, tokens, line, col):
+    if tokens[0][0] != 'IDENT':
+        raise ParseException('Identifier value only for property "%(property)s"' % locals(), line, col)
 
-        value = numbers(*values)
+    if tokens[0][1] not in kind:
+        raise ParseException('Unrecognized value for property "%(property)s"' % locals(), line, col)
 
-    elif properties[property.name] is strings:
-        values = []
+    return identifier_values.setdefault(tokens[0][1], str(tokens[0][1]))
+
+def parse_numbers_value(property, kind, tokens, line, col):
+    values = []
     
-        # strip spaces from the list
-        relevant_tokens = [token for token in tokens if token[0] != 'S']
-        
-        for (i, token) in enumerate(relevant_tokens):
-            if (i % 2) == 0 and token[0] == 'STRING':
-                values.append(str(token[1][1:-1]))
-            
-            elif (i % 2) == 1 and token == ('CHAR', ','):
-                # fine, it's a comma
-                continue
-            
-            else:
-                raise ParseException('Value for property "%(property)s" should be a comma-delimited list of strings' % locals(), line, col)
+    # strip spaces from the list
+    relevant_tokens = [token for token in tokens if token[0] != 'S']
     
-        value = strings(*values)
+    for (i, token) in enumerate(relevant_tokens):
+        if (i % 2) == 0 and token[0] == 'NUMBER':
+            try:
+                value = int(token[1])
+            except ValueError:
+                value = float(token[1])
 
-    return Value(value, important)
+            values.append(value)
+
+        elif (i % 2) == 1 and token[0] == 'CHAR':
+            # fine, it's a comma
+            continue
+
+        else:
+            raise ParseException('Value for property "%(property)s" should be a comma-delimited list of numbers' % locals(), line, col)
+
+    return numbers(*values)
+
+def parse_strings_value(property, kind, tokens, line, col):
+    values = []
+
+    # strip spaces from the list
+    relevant_tokens = [token for token in tokens if token[0] != 'S']
+    
+    for (i, token) in enumerate(relevant_tokens):
+        if (i % 2) == 0 and token[0] == 'STRING':
+            values.append(str(token[1][1:-1]))
+        
+        elif (i % 2) == 1 and token == ('CHAR', ','):
+            # fine, it's a comma
+            continue
+        
+        else:
+            raise ParseException('Value for property "%(property)s" should be a comma-delimited list of strings' % locals(), line, col)
+
+    return strings(*values)
+
+# value parsers for each kind of property, with tuple for enumerated identifiers.
+value_parsers = {
+    int: parse_int_value,
+    float: parse_float_value,
+    str: parse_str_value,
+    color: parse_color_value,
+    color_transparent: parse_color_transparent_value,
+    uri: parse_uri_value,
+    boolean: parse_boolean_value,
+    tuple: parse_identifier_value,
+    numbers: parse_numbers_value,
+    strings: parse_strings_value
+    }
+
+# color_transparent takes the first of several values, as it always has.
+single_value_parsers = set((parse_int_value, parse_float_value, parse_str_value,
+                            parse_color_value, parse_uri_value, parse_boolean_value,
+                            parse_identifier_value))
 
 def parse_block(tokens, variables, selectors, is_merc):
     """ Parse a token stream into an array of declaration tuples.
@@ -416,7 +695,15 @@ def parse_block(tokens, variables, selectors, is_merc):
                 # Possible variable use:
                 # http://lesscss.org/#-variables
                 #
-                tokens = chain(iter(variables[tvalue]), tokens)
+                if tvalue not in variables:
+                    raise ParseException('Undefined variable "%s"' % tvalue, line, col)
+                
+                variable = variables[tvalue].resolve(variables, line, col)
+                
+                if variable.inline:
+                    value += variable.values
+                else:
+                    tokens = chain(variable.tokens, tokens)
             elif (tname, tvalue) == ('S', '\n'):
                 raise ParseException('Unexpected end of line', line, col)
             elif tname not in ('S', 'COMMENT'):
@@ -540,7 +827,9 @@ def parse_rule(tokens, variables, neighbors, parents, is_merc):
             raise ParseException('Only the first element in a selector may have a class in Mapnik styles', line, col)
     
     def parse_variable_definition(tokens):
-        """ Look for variable value tokens after an @keyword, return an array.
+        """ Look for variable value tokens after an @keyword, return a Variable.
+        
+            Uses of other variables are left for Variable.resolve().
         """
         while True:
             tname, tvalue, line, col = tokens.next()
@@ -552,7 +841,7 @@ def parse_rule(tokens, variables, neighbors, parents, is_merc):
                     tname, tvalue, line, col = tokens.next()
             
                     if (tname, tvalue) in (('CHAR', ';'), ('S', '\n')):
-                        return vtokens
+                        return Variable(vtokens)
                     
                     elif tname not in ('S', 'COMMENT'):
                         vtokens.append((tname, tvalue, line, col))
@@ -688,19 +977,25 @@ def parse_rule(tokens, variables, neighbors, parents, is_merc):
                     if len(neighbor.elements) == 0:
                         raise ParseException('At least one element must be present in selectors for Mapnik styles', line, col)
                     
-                    elements = chain(parent.elements + neighbor.elements)
-                    selector = Selector(deepcopy(elements.next()))
+                    #
+                    # Names and tests are never modified, so new elements
+                    # only need their own lists, not copies of their contents.
+                    #
+                    new_elements = []
                     
-                    for element in elements:
-                        if element.__class__ is ConcatenatedElement:
-                            for name in element.names: selector.elements[-1].addName(deepcopy(name))
-                            for test in element.tests: selector.elements[-1].addTest(deepcopy(test))
+                    for element in parent.elements + neighbor.elements:
+                        if new_elements and element.__class__ is ConcatenatedElement:
+                            new_elements[-1].names += element.names
+                            new_elements[-1].tests += element.tests
                         else:
-                            selector.addElement(deepcopy(element))
+                            new_elements.append(element.__class__(list(element.names), list(element.tests)))
+                    
+                    selector = Selector(*new_elements)
                     
                     # selector should be fully valid at this point.
                     validate_selector_elements(selector.elements, line, col)
                     selector.convertZoomTests(is_merc)
+                    selector.finalize()
                     selectors.append(selector)
             
             return parse_block(tokens, variables, selectors, is_merc)
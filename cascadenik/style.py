@@ -1,5 +1,5 @@
 from math import log
-from copy import deepcopy
+from weakref import WeakValueDictionary
 import operator
 
 class color:
@@ -355,9 +355,42 @@ properties = {
     'shield-meta-writer': str,
 }
 
-class Declaration:
+#
+# Midpoint values for spherical mercator scale denominators at a range
+# of zoom levels, based on 96dpi values from Microsoft documentation.
+# http://msdn.microsoft.com/en-us/library/bb259689.aspx
+#
+zoom_scale_denominators = {
+     0: (418365887, 836731773),
+     1: (209182943, 418365886),
+     2: (104591472, 209182943),
+     3: (52295736, 104591472),
+     4: (26147868, 52295736),
+     5: (13073934, 26147868),
+     6: (6536967, 13073934),
+     7: (3268484, 6536967),
+     8: (1634242, 3268484),
+     9: (817121, 1634242),
+    10: (408561, 817121),
+    11: (204280, 408561),
+    12: (102140, 204280),
+    13: (51070, 102140),
+    14: (25535, 51070),
+    15: (12768, 25535),
+    16: (6384, 12768),
+    17: (3192, 6384),
+    18: (1596, 3192),
+    19: (798, 1596),
+    20: (399, 798),
+    21: (200, 399),
+    22: (100, 200),
+}
+
+class Declaration(object):
     """ Bundle with a selector, single property and value.
     """
+    __slots__ = ('selector', 'property', 'value', 'sort_key')
+
     def __init__(self, selector, property, value, sort_key):
         self.selector = selector
         self.property = property
@@ -365,89 +398,102 @@ class Declaration:
         self.sort_key = sort_key
 
     def __repr__(self):
-        return u'%(selector)s { %(property)s: %(value)s }' % self.__dict__
+        return u'%s { %s: %s }' % (self.selector, self.property, self.value)
     
     def scaleBy(self, scale):
         self.selector = self.selector.scaledBy(scale)
         
         if not self.property.name.endswith('-opacity'):
             self.value = self.value.scaledBy(scale)
+    
+    def scaledBy(self, scale):
+        """ Return a new Declaration scaled by a number, leaving this one as-is.
+        """
+        scaled = Declaration(self.selector, self.property, self.value, self.sort_key)
+        scaled.scaleBy(scale)
+        
+        return scaled
 
-class Selector:
+class Selector(object):
     """ Represents a complete selector with elements and attribute checks.
+    
+        Specificity and lists of tests are computed once, by finalize()
+        or on first use, and from then on the selector can't be changed.
     """
+    __slots__ = ('elements', 'derived')
+
     def __init__(self, *elements):
         self.elements = elements[:]
+        self.derived = None
 
     def addElement(self, element):
+        assert self.derived is None, 'Selector can not be changed after finalize()'
         self.elements = tuple(list(self.elements) + [element])
     
     def convertZoomTests(self, is_merc):
-        """ Modify the tests on this selector to use mapnik-friendly
+        """ Replace the tests on this selector with mapnik-friendly
             scale-denominator instead of shorthand zoom.
+            
+            Tests themselves are never modified, so they can be shared.
         """
-        #
-        # Midpoint values for spherical mercator scale denominators at a range
-        # of zoom levels, based on 96dpi values from Microsoft documentation.
-        # http://msdn.microsoft.com/en-us/library/bb259689.aspx
-        #
-        zooms = {
-             0: (418365887, 836731773),
-             1: (209182943, 418365886),
-             2: (104591472, 209182943),
-             3: (52295736, 104591472),
-             4: (26147868, 52295736),
-             5: (13073934, 26147868),
-             6: (6536967, 13073934),
-             7: (3268484, 6536967),
-             8: (1634242, 3268484),
-             9: (817121, 1634242),
-            10: (408561, 817121),
-            11: (204280, 408561),
-            12: (102140, 204280),
-            13: (51070, 102140),
-            14: (25535, 51070),
-            15: (12768, 25535),
-            16: (6384, 12768),
-            17: (3192, 6384),
-            18: (1596, 3192),
-            19: (798, 1596),
-            20: (399, 798),
-            21: (200, 399),
-            22: (100, 200),
-           }
+        assert self.derived is None, 'Selector can not be changed after finalize()'
+        tests, extra_tests = [], []
         
         for test in self.elements[0].tests:
-            if test.property == 'zoom':
-                if not is_merc:
-                    # TODO - should we warn instead that values may not be appropriate?
-                    raise NotImplementedError('Map srs is not web mercator, so zoom level shorthand cannot be propertly converted to Min/Max scaledenominators')
-
-                test.property = 'scale-denominator'
-
-                if test.op == '=':
-                    # zoom level equality implies two tests, so we add one and modify one
-                    self.elements[0].addTest(SelectorAttributeTest('scale-denominator', '<', max(zooms[test.value])))
-                    test.op, test.value = '>=', min(zooms[test.value])
-
-                elif test.op == '<':
-                    test.op, test.value = '>=', max(zooms[test.value])
-                elif test.op == '<=':
-                    test.op, test.value = '>=', min(zooms[test.value])
-                elif test.op == '>=':
-                    test.op, test.value = '<', max(zooms[test.value])
-                elif test.op == '>':
-                    test.op, test.value = '<', min(zooms[test.value])
-
+            if test.property != 'zoom':
+                tests.append(test)
+                continue
+            
+            if not is_merc:
+                # TODO - should we warn instead that values may not be appropriate?
+                raise NotImplementedError('Map srs is not web mercator, so zoom level shorthand cannot be propertly converted to Min/Max scaledenominators')
+
+            if test.op == '=':
+                # zoom level equality implies two tests, so we add one and modify one
+                extra_tests.append(SelectorAttributeTest('scale-denominator', '<', max(zoom_scale_denominators[test.value])))
+                op, value = '>=', min(zoom_scale_denominators[test.value])
+
+            elif test.op == '<':
+                op, value = '>=', max(zoom_scale_denominators[test.value])
+            elif test.op == '<=':
+                op, value = '>=', min(zoom_scale_denominators[test.value])
+            elif test.op == '>=':
+                op, value = '<', max(zoom_scale_denominators[test.value])
+            elif test.op == '>':
+                op, value = '<', min(zoom_scale_denominators[test.value])
+            else:
+                op, value = test.op, test.value
+            
+            tests.append(SelectorAttributeTest('scale-denominator', op, value))
+        
+        self.elements[0].tests = tests + extra_tests
 
-    def specificity(self):
-        """ Loosely based on http://www.w3.org/TR/REC-CSS2/cascade.html#specificity
+    def finalize(self):
+        """ Freeze names and tests of all elements into tuples,
+            and compute values derived from them.
+            
+            Called once a selector is complete, after convertZoomTests().
         """
+        for element in self.elements:
+            element.names, element.tests = tuple(element.names), tuple(element.tests)
+        
+        # loosely based on http://www.w3.org/TR/REC-CSS2/cascade.html#specificity
         ids = sum(a.countIDs() for a in self.elements)
         non_ids = sum((a.countNames() - a.countIDs()) for a in self.elements)
         tests = sum(len(a.tests) for a in self.elements)
         
-        return (ids, non_ids, tests)
+        all_tests = self.elements[0].tests
+        range_tests = tuple([test for test in all_tests if test.isRanged()])
+        map_scale_tests = tuple([test for test in all_tests if test.isMapScaled()])
+        
+        self.derived = (ids, non_ids, tests), all_tests, range_tests, map_scale_tests
+        
+        return self.derived
+
+    def specificity(self):
+        """ Loosely based on http://www.w3.org/TR/REC-CSS2/cascade.html#specificity
+        """
+        return (self.derived or self.finalize())[0]
 
     def matches(self, tag, id, classes):
         """ Given an id and a list of classes, return True if this selector would match.
@@ -481,7 +527,7 @@ class Selector:
     def rangeTests(self):
         """
         """
-        return [test for test in self.allTests() if test.isRanged()]
+        return (self.derived or self.finalize())[2]
     
     def isMapScaled(self):
         """
@@ -491,17 +537,12 @@ class Selector:
     def mapScaleTests(self):
         """
         """
-        return [test for test in self.allTests() if test.isMapScaled()]
+        return (self.derived or self.finalize())[3]
     
     def allTests(self):
         """
         """
-        tests = []
-        
-        for test in self.elements[0].tests:
-            tests.append(test)
-
-        return tests
+        return (self.derived or self.finalize())[1]
     
     def inRange(self, value):
         """
@@ -512,26 +553,52 @@ class Selector:
 
         return True
 
+    def isCompatible(self, tests):
+        """ Given a collection of tests, return false if any test of this
+            selector contradicts any of them. Same as checking each with
+            SelectorAttributeTest.isCompatible(), in a single call.
+        """
+        for own in (self.derived or self.finalize())[1]:
+            for test in tests:
+                if own.property == test.property:
+                    contradicts = contradictions.get((own.op, test.op), None)
+                    
+                    if contradicts is not None and contradicts(own.value, test.value):
+                        return False
+
+        return True
+
     def scaledBy(self, scale):
         """ Return a new Selector with scale denominators scaled by a number.
+        
+            Only the first element is new, other elements and unscaled
+            tests are shared with this selector.
         """
-        scaled = deepcopy(self)
+        tests = []
     
-        for test in scaled.elements[0].tests:
+        for test in self.elements[0].tests:
             if type(test.value) in (int, float):
                 if test.property == 'scale-denominator':
-                    test.value /= scale
+                    test = SelectorAttributeTest(test.property, test.op, test.value / scale)
                 elif test.property == 'zoom':
-                    test.value += log(scale)/log(2)
+                    test = SelectorAttributeTest(test.property, test.op, test.value + log(scale)/log(2))
+            
+            tests.append(test)
+        
+        first = self.elements[0].__class__(list(self.elements[0].names), tests)
+        scaled = Selector(first, *self.elements[1:])
+        scaled.finalize()
         
         return scaled
     
     def __repr__(self):
         return u' '.join(repr(a) for a in self.elements)
 
-class SelectorElement:
+class SelectorElement(object):
     """ One element in selector, with names and tests.
     """
+    __slots__ = ('names', 'tests')
+
     def __init__(self, names=None, tests=None):
         if names:
             self.names = names
@@ -567,25 +634,75 @@ class SelectorElement:
 class ConcatenatedElement (SelectorElement):
     """
     """
+    __slots__ = ()
+
     def __repr__(self):
         return '&' + SelectorElement.__repr__(self)
 
-class SelectorAttributeTest:
+class SelectorAttributeTest(object):
     """ Attribute test for a Selector, i.e. the part that looks like "[foo=bar]"
+    
+        Tests are interned: making a test with the same property, operator
+        and value as an existing one returns that same object, so they must
+        never be modified. Key is the (property, op, value) tuple, and tests
+        compare and order by sort_key, with scale-denominator tests first.
+        Tests are never equal to anything else.
     """
-    def __init__(self, property, op, value):
-        assert op in ('<', '<=', '=', '!=', '>=', '>')
-        self.op = op
-        self.property = str(property)
-        self.value = value
+    __slots__ = ('property', 'op', 'value', 'key', 'sort_key', 'hash', '__weakref__')
+    
+    # ints and floats are kept apart, because 1 and 1.0 look different in output.
+    interned = WeakValueDictionary()
+
+    def __new__(cls, property, op, value):
+        property = str(property)
+        is_float = type(value) is float
+        
+        test = cls.interned.get((property, op, value, is_float))
+        
+        if test is None:
+            assert op in ('<', '<=', '=', '!=', '>=', '>')
+            test = object.__new__(cls)
+            test.op = op
+            test.property = property
+            test.value = value
+            test.key = (property, op, value)
+            test.sort_key = (property != 'scale-denominator', property, op, value, is_float)
+            
+            # same hash as the text of the test, so dictionaries of tests
+            # keep the order they had back when they were keyed by text.
+            test.hash = hash(unicode(test))
+            cls.interned[(property, op, value, is_float)] = test
+        
+        return test
+
+    def __reduce__(self):
+        return (SelectorAttributeTest, (self.property, self.op, self.value))
 
     def __repr__(self):
-        return u'[%(property)s%(op)s%(value)s]' % self.__dict__
+        return u'[%s%s%s]' % (self.property, self.op, self.value)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if not isinstance(other, SelectorAttributeTest):
+            return NotImplemented
+        
+        return self.sort_key == other.sort_key
+
+    def __ne__(self, other):
+        if not isinstance(other, SelectorAttributeTest):
+            return NotImplemented
+        
+        return self.sort_key != other.sort_key
 
     def __cmp__(self, other):
         """
         """
-        return cmp(unicode(self), unicode(other))
+        if not isinstance(other, SelectorAttributeTest):
+            return NotImplemented
+        
+        return cmp(self.sort_key, other.sort_key)
 
     def isSimple(self):
         """
@@ -647,123 +764,12 @@ class SelectorAttributeTest:
     def isCompatible(self, tests):
         """ Given a collection of tests, return false if this test contradicts any of them.
         """
-        # print '?', self, tests
-        
         for test in tests:
             if self.property == test.property:
-                if self.op == '=':
-                    if test.op == '=' and self.value != test.value:
-                        return False
-    
-                    if test.op == '!=' and self.value == test.value:
-                        return False
-    
-                    if test.op == '<' and self.value >= test.value:
-                        return False
-                
-                    if test.op == '>' and self.value <= test.value:
-                        return False
-                
-                    if test.op == '<=' and self.value > test.value:
-                        return False
-                
-                    if test.op == '>=' and self.value < test.value:
-                        return False
-            
-                if self.op == '!=':
-                    if test.op == '=' and self.value == test.value:
-                        return False
-    
-                    if test.op == '!=':
-                        pass
-    
-                    if test.op == '<':
-                        pass
-                
-                    if test.op == '>':
-                        pass
-                
-                    if test.op == '<=' and self.value == test.value:
-                        return False
-                
-                    if test.op == '>=' and self.value == test.value:
-                        return False
-            
-                if self.op == '<':
-                    if test.op == '=' and self.value <= test.value:
-                        return False
-    
-                    if test.op == '!=':
-                        return False
-    
-                    if test.op == '<':
-                        pass
-                
-                    if test.op == '>' and self.value <= test.value:
-                        return False
-                
-                    if test.op == '<=':
-                        pass
-                
-                    if test.op == '>=' and self.value <= test.value:
-                        return False
-            
-                if self.op == '>':
-                    if test.op == '=' and self.value >= test.value:
-                        return False
-    
-                    if test.op == '!=':
-                        return False
-    
-                    if test.op == '<' and self.value >= test.value:
-                        return False
+                contradicts = contradictions.get((self.op, test.op), None)
                 
-                    if test.op == '>':
-                        pass
-                
-                    if test.op == '<=' and self.value >= test.value:
-                        return False
-                
-                    if test.op == '>=':
-                        pass
-            
-                if self.op == '<=':
-                    if test.op == '=' and self.value < test.value:
-                        return False
-    
-                    if test.op == '!=' and self.value == test.value:
-                        return False
-    
-                    if test.op == '<':
-                        pass
-                
-                    if test.op == '>' and self.value <= test.value:
-                        return False
-                
-                    if test.op == '<=':
-                        pass
-                
-                    if test.op == '>=' and self.value < test.value:
-                        return False
-            
-                if self.op == '>=':
-                    if test.op == '=' and self.value > test.value:
-                        return False
-    
-                    if test.op == '!=' and self.value == test.value:
-                        return False
-    
-                    if test.op == '<' and self.value >= test.value:
-                        return False
-                
-                    if test.op == '>':
-                        pass
-                
-                    if test.op == '<=' and self.value > test.value:
-                        return False
-                
-                    if test.op == '>=':
-                        pass
+                if contradicts is not None and contradicts(self.value, test.value):
+                    return False
 
         return True
     
@@ -773,9 +779,36 @@ class SelectorAttributeTest:
 
         return None
 
-class Property:
+#
+# For each pair of (own operator, other operator), a function of the two
+# values that's true when the two tests can't both be true. Missing pairs
+# never contradict. "[a<x]" and "[a>x]" contradict "[a!=y]", as always.
+#
+contradictions = {
+    ('=', '='): operator.ne, ('=', '!='): operator.eq,
+    ('=', '<'): operator.ge, ('=', '>'): operator.le,
+    ('=', '<='): operator.gt, ('=', '>='): operator.lt,
+
+    ('!=', '='): operator.eq, ('!=', '<='): operator.eq, ('!=', '>='): operator.eq,
+
+    ('<', '='): operator.le, ('<', '!='): lambda a, b: True,
+    ('<', '>'): operator.le, ('<', '>='): operator.le,
+
+    ('>', '='): operator.ge, ('>', '!='): lambda a, b: True,
+    ('>', '<'): operator.ge, ('>', '<='): operator.ge,
+
+    ('<=', '='): operator.lt, ('<=', '!='): operator.eq,
+    ('<=', '>'): operator.le, ('<=', '>='): operator.lt,
+
+    ('>=', '='): operator.gt, ('>=', '!='): operator.eq,
+    ('>=', '<'): operator.ge, ('>=', '<='): operator.gt
+    }
+
+class Property(object):
     """ A style property.
     """
+    __slots__ = ('name', )
+
     def __init__(self, name):
         assert name in properties
     
@@ -790,9 +823,11 @@ class Property:
     def __str__(self):
         return repr(self)
 
-class Value:
+class Value(object):
     """ A style value.
     """
+    __slots__ = ('value', 'important')
+
     def __init__(self, value, important):
         self.value = value
         self.important = important
@@ -802,15 +837,17 @@ class Value:
     
     def scaledBy(self, scale):
         """ Return a new Value scaled by a given number for ints and floats.
+        
+            Values of other types are shared with this one, not copied.
         """
-        scaled = deepcopy(self)
+        value = self.value
     
-        if type(scaled.value) in (int, float):
-            scaled.value *= scale
-        elif isinstance(scaled.value, numbers):
-            scaled.value.values = (v * scale for v in scaled.value.values)
+        if type(value) in (int, float):
+            value = value * scale
+        elif isinstance(value, numbers):
+            value = numbers(*[v * scale for v in value.values])
         
-        return scaled
+        return Value(value, self.important)
     
     def __repr__(self):
         return repr(self.value)
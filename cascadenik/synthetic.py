@@ -0,0 +1,81 @@
+""" Generated stylesheets and maps of any size, for tests and benchmarks.
+
+Each dimension grows a different part of the work done by compile():
+
+  layers      Layer elements, each with its own rules.
+  classes     Classes shared by every layer, each with its own rule.
+  attributes  Attribute properties per layer, each tested for two values;
+              this is what makes tests_filter_combinations() grow fastest.
+  zooms       Zoom breakpoints per layer, from zoom 10 up.
+  depth       Levels of nested rules per layer, each adding another test.
+
+Output is deterministic, so the same sizes always give the same text.
+"""
+from xml.sax.saxutils import escape, quoteattr
+
+merc_srs = '+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null'
+
+palette = ('#f90', '#369', '#c33', '#6c6', '#999', '#fc0', '#036', '#963')
+
+def stylesheet(layers=1, classes=1, attributes=1, zooms=1, depth=1):
+    """ Return the text of a stylesheet with rules for the given sizes.
+    """
+    lines = []
+
+    for j in range(classes):
+        lines.append('.class%d { line-opacity: %.1f; }' % (j, 1 - (j % 10) / 20.))
+
+    for i in range(layers):
+        layer = '#layer%d' % i
+
+        lines.append('%s { line-color: %s; line-width: 1; }' % (layer, palette[i % len(palette)]))
+
+        for k in range(attributes):
+            color = palette[(i + k) % len(palette)]
+            lines.append('%s[attr%d=yes] { line-color: %s; }' % (layer, k, color))
+            lines.append('%s[attr%d=no] { line-width: %d; }' % (layer, k, k + 2))
+
+        for z in range(zooms):
+            lines.append('%s[zoom>=%d] { line-width: %d; }' % (layer, 10 + z, z + 2))
+
+        if depth:
+            lines.append(nested_block(layer, depth))
+
+    return '\n'.join(lines) + '\n'
+
+def nested_block(selector, depth, level=0):
+    """ Return the text of a rule with further rules nested depth levels deep.
+    """
+    indent = '    ' * level
+    inner = ''
+
+    if level + 1 < depth:
+        inner = nested_block('&[level%d=yes]' % (level + 1), depth, level + 1) + '\n'
+
+    return '%s%s { line-cap: round; line-width: %d;\n%s%s}' % (indent, selector, level + 1, inner, indent)
+
+def mapfile(layers=1, classes=1, attributes=1, zooms=1, depth=1, href=None):
+    """ Return the text of a map with layers for the given sizes.
+
+        The stylesheet is included inline unless href is given, in which
+        case it's left to the caller to write stylesheet() there.
+    """
+    if href is None:
+        style = '    <Stylesheet>\n%s    </Stylesheet>' % escape(stylesheet(layers, classes, attributes, zooms, depth))
+    else:
+        style = '    <Stylesheet src=%s/>' % quoteattr(href)
+
+    class_names = ' '.join(['class%d' % j for j in range(classes)])
+    elements = ['<?xml version="1.0"?>', '<Map srs=%s>' % quoteattr(merc_srs), style]
+
+    for i in range(layers):
+        elements.append('    <Layer id="layer%d" class="%s">' % (i, class_names))
+        elements.append('        <Datasource>')
+        elements.append('            <Parameter name="type">shape</Parameter>')
+        elements.append('            <Parameter name="file">layer%d.shp</Parameter>' % i)
+        elements.append('        </Datasource>')
+        elements.append('    </Layer>')
+
+    elements.append('</Map>')
+
+    return '\n'.join(elements) + '\n'
@@ -7,6 +7,7 @@ Run as a module, like this:
 
 import os
 import sys
+import cPickle
 import shutil
 import urllib
 import urlparse
@@ -14,19 +15,26 @@ import os.path
 import unittest
 import tempfile
 import xml.etree.ElementTree
+from itertools import product
 
 from .style import color, numbers, strings, boolean
 from .style import Property, Selector, SelectorElement, SelectorAttributeTest
-from .parse import ParseException, postprocess_value, stylesheet_declarations
-from .compile import tests_filter_combinations, Filter, selectors_tests
-from .compile import filtered_property_declarations, is_applicable_selector
+from .parse import ParseException, postprocess_value, stylesheet_declarations, iter_stylesheet_declarations, RulesetCache
+from .tokenizer import Tokenizer
+from .compile import tests_filter_combinations, iter_tests_filter_combinations, Filter, selectors_tests
+from .compile import filtered_property_declarations, is_applicable_selector, CascadeContext, coalesce_rules
+from .compile import cartesian_cascade, cascade_rule
 from .compile import get_polygon_rules, get_line_rules, get_text_rule_groups, get_shield_rule_groups
 from .compile import get_point_rules, get_polygon_pattern_rules, get_line_pattern_rules
-from .compile import test2str, compile
-from .compile import Directories
+from .compile import test2str, compile, compile_scaled, cached_stylesheet_declarations, extract_declarations
+from .compile import Directories, DeclarationIndex, Profile
 from .sources import DataSources
 from . import mapnik, MAPNIK_VERSION
 from . import output
+from . import synthetic
+
+# the package exports a compile() function under the same name as the module
+compile_module = sys.modules[cached_stylesheet_declarations.__module__]
     
 class ParseTests(unittest.TestCase):
     
@@ -102,6 +110,231 @@ class ParseTests(unittest.TestCase):
     def testDeclarations5(self):
         self.assertEqual(2, len(stylesheet_declarations('Map { line-width: 1; }')))
 
+    def testIterDeclarations(self):
+        s = """
+            Layer#roads { line-width: 1 !important; }
+            Layer { line-width: 2; line-color: #f00; &.minor { line-width: 3; } }
+            Layer#roads { line-width: 4; }
+            Layer { line-width: 5; }
+        """
+        declarations = iter_stylesheet_declarations(s)
+        
+        self.assertFalse(isinstance(declarations, list))
+        self.assertEqual(['display', 'line-width', 'line-color', 'line-width', 'line-width', 'line-width', 'line-width'],
+                         [d.property.name for d in stylesheet_declarations(s)])
+        self.assertEqual(['map', '2.0', '#ff0000', '5.0', '3.0', '4.0', '1.0'],
+                         [str(d.value) for d in declarations])
+
+    def testRulesetCache1(self):
+        s1 = """@wide: 4;
+            Layer { line-width: 1; }
+            .roads { line-width: @wide; &.minor { line-width: 2; } }
+            .rail { line-color: #000; }"""
+        
+        s2 = """@wide: 4;
+            Layer { line-width: 1.5;
+              line-color: #f90; }
+            .roads { line-width: @wide; &.minor { line-width: 2; } }   .rail { line-color: #000; }"""
+        
+        def summary(declarations):
+            return [(str(d.selector), str(d.property), str(d.value), d.sort_key) for d in declarations]
+        
+        cache = RulesetCache()
+        
+        self.assertEqual(summary(stylesheet_declarations(s1, cache=cache)), summary(stylesheet_declarations(s1)))
+        self.assertEqual(summary(stylesheet_declarations(s2, cache=cache)), summary(stylesheet_declarations(s2)))
+        self.assertEqual(3, len(cache.entries))
+        
+        # a changed variable means a changed rule set
+        s3 = s2.replace('@wide: 4;', '@wide: 5;')
+        self.assertEqual(summary(stylesheet_declarations(s3, cache=cache)), summary(stylesheet_declarations(s3)))
+        self.assertEqual(['1.5', '5.0', '2.0'], [str(d.value) for d in stylesheet_declarations(s3, cache=cache) if d.property.name == 'line-width'])
+
+    def testRulesetCache2(self):
+        # braces in a variable throw off rule set boundaries
+        s = '@odd: 1 }; Layer { line-width: @odd .minor { line-width: 2; }'
+        
+        cache = RulesetCache()
+        
+        self.assertEqual(map(str, stylesheet_declarations(s)), map(str, stylesheet_declarations(s, cache=cache)))
+        self.assertEqual(0, len(cache.entries))
+
+    def testCachedDeclarations(self):
+        s = u'Layer[zoom>=10] { line-width: 2; line-color: #f90; point-file: url("a.png"); }'
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        
+        try:
+            declarations = cached_stylesheet_declarations(s, True, 1, cache_dir)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            
+            cached = cached_stylesheet_declarations(s, True, 1, cache_dir)
+            self.assertEqual(1, len(os.listdir(cache_dir)))
+            self.assertEqual(map(str, declarations), map(str, cached))
+            self.assertEqual([d.sort_key for d in declarations], [d.sort_key for d in cached])
+            
+            scaled = cached_stylesheet_declarations(s, True, 2, cache_dir)
+            self.assertEqual(2, len(os.listdir(cache_dir)))
+            self.assertEqual(4, [d.value.value for d in scaled if d.property.name == 'line-width'][0])
+            
+            # a new cache format must not read back older pickles
+            cache_format = compile_module.CACHE_FORMAT
+            
+            try:
+                compile_module.CACHE_FORMAT += 1
+                cached_stylesheet_declarations(s, True, 1, cache_dir)
+                self.assertEqual(3, len(os.listdir(cache_dir)))
+            finally:
+                compile_module.CACHE_FORMAT = cache_format
+        
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testCachedInlineDeclarations(self):
+        href = 'file:///example/'
+        first = u'Layer { line-width: 1; }\n.roads { line-width: 2; }'
+        second = u'Layer { line-color: #f90; }'
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        
+        parse_module = sys.modules[stylesheet_declarations.__module__]
+        parse_chunk, chunks = parse_module.parse_chunk, []
+        
+        def counted_parse_chunk(chunk, *args):
+            chunks.append(chunk)
+            return parse_chunk(chunk, *args)
+        
+        try:
+            parse_module.parse_chunk = counted_parse_chunk
+            
+            # two inline stylesheets with one href have separate cache files
+            cached_stylesheet_declarations(first, True, 1, cache_dir, href, 0)
+            cached_stylesheet_declarations(second, True, 1, cache_dir, href, 1)
+            self.assertEqual(4, len(os.listdir(cache_dir)))
+            self.assertEqual(3, len(chunks))
+            
+            # an edit replaces them, and only the changed rule set is parsed
+            edited = first.replace('2;', '3;')
+            declarations = cached_stylesheet_declarations(edited, True, 1, cache_dir, href, 0)
+            self.assertEqual(4, len(os.listdir(cache_dir)))
+            self.assertEqual(4, len(chunks))
+            self.assertEqual(map(str, stylesheet_declarations(edited, True)), map(str, declarations))
+            
+            cached = cached_stylesheet_declarations(edited, True, 1, cache_dir, href, 0)
+            self.assertEqual(4, len(chunks))
+            self.assertEqual(map(str, declarations), map(str, cached))
+        
+        finally:
+            parse_module.parse_chunk = parse_chunk
+            shutil.rmtree(cache_dir)
+
+    def testExtractDeclarations(self):
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        
+        try:
+            user_style = os.path.join(cache_dir, 'user.mss')
+            open(user_style, 'w').write('Layer { line-width: 3; point-file: url("b.png"); }')
+            dirs = Directories(cache_dir, cache_dir, cache_dir)
+            
+            results = []
+            
+            for workers in (1, 2):
+                map_el = xml.etree.ElementTree.fromstring("""
+                    <Map>
+                        <Stylesheet>Layer { line-width: 1; point-file: url("a.png"); }</Stylesheet>
+                        <Stylesheet>Layer { line-width: 2; }</Stylesheet>
+                    </Map>
+                    """)
+                
+                declarations = extract_declarations(map_el, dirs, 1, ['user.mss'], workers)
+                results.append([(str(d.property), str(d.value)) for d in declarations])
+                self.assertEqual(0, len(map_el.findall('Stylesheet')))
+            
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(['1.0', '2.0', '3.0'], [value for (name, value) in results[1] if name == 'line-width'])
+            self.assertEqual(['file://%s/a.png' % cache_dir, 'file://%s/b.png' % cache_dir],
+                             [value for (name, value) in results[1] if name == 'point-file'])
+        
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testExtractDeclarationsProfile(self):
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+        
+        try:
+            dirs = Directories(cache_dir, cache_dir, cache_dir)
+            phases = []
+            
+            for workers in (1, 2):
+                map_el = xml.etree.ElementTree.fromstring("""
+                    <Map>
+                        <Stylesheet>Layer { line-width: %d; }</Stylesheet>
+                        <Stylesheet>Layer { line-opacity: 0.%d; }</Stylesheet>
+                    </Map>
+                    """ % (workers, workers))
+                
+                # every stylesheet is parsed and counted, even in a worker
+                compile_module.PROFILE = Profile()
+                extract_declarations(map_el, dirs, 1, [], workers)
+                phases.append(compile_module.PROFILE.phases['stylesheet_declarations'][0])
+            
+            self.assertEqual([2, 2], phases)
+        
+        finally:
+            compile_module.PROFILE = None
+            shutil.rmtree(cache_dir)
+
+    def testSynthetic(self):
+        sizes = dict(layers=2, classes=3, attributes=2, zooms=2, depth=2)
+        self.assertEqual(synthetic.stylesheet(**sizes), synthetic.stylesheet(**sizes))
+
+        # implicit display, three classes, then for each layer two base,
+        # four attribute, two zoom and four nested declarations.
+        declarations = stylesheet_declarations(synthetic.stylesheet(**sizes), is_merc=True)
+        self.assertEqual(1 + 3 + 2 * 12, len(declarations))
+        self.assertEqual('#layer1[level1=yes]', str(declarations[-1].selector))
+
+        map_el = xml.etree.ElementTree.fromstring(synthetic.mapfile(href='synthetic.mss', **sizes))
+        self.assertEqual('synthetic.mss', map_el.find('Stylesheet').get('src'))
+        self.assertEqual(['layer0', 'layer1'], [layer_el.get('id') for layer_el in map_el.findall('Layer')])
+
+        cache_dir = tempfile.mkdtemp(prefix='cascadenik-tests-')
+
+        try:
+            map = compile(synthetic.mapfile(**sizes), Directories(cache_dir, cache_dir, cache_dir))
+            self.assertEqual(2, len(map.layers))
+            self.assertTrue(isinstance(map.layers[1].styles[0].rules[0].symbolizers[0], output.LineSymbolizer))
+
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def testTokenizer1(self):
+        s = u'@x: #f90;\nLayer[zoom>=10] {\n  /* c */ point-file: url("a.png");\n  text-face-name: "DejaVu\\\nSans" 1.5;\n}'
+        tokens = list(Tokenizer().tokenize(s))
+        
+        self.assertEqual(('ATKEYWORD', u'@x', 1, 1), tokens[0])
+        self.assertEqual(('CHAR', u':', 1, 3), tokens[1])
+        self.assertEqual(('HASH', u'#f90', 1, 5), tokens[3])
+        self.assertEqual(('S', u'\n', 1, 10), tokens[5])
+        self.assertEqual(('IDENT', u'Layer', 2, 1), tokens[6])
+        self.assertEqual(('NUMBER', u'10', 2, 13), tokens[11])
+        self.assertEqual(('S', u'\n  ', 2, 18), tokens[15])
+        self.assertEqual(('COMMENT', u'/* c */', 3, 3), tokens[16])
+        self.assertEqual(('URI', u'url("a.png")', 3, 23), tokens[21])
+        self.assertEqual(('STRING', u'"DejaVuSans"', 4, 19), tokens[27])
+        self.assertEqual(('NUMBER', u'1.5', 5, 7), tokens[29])
+        self.assertEqual(('CHAR', u'}', 6, 1), tokens[-1])
+
+    def testTokenizer2(self):
+        try:
+            from cssutils.tokenize2 import Tokenizer as cssTokenizer
+        except ImportError:
+            # nothing to compare with
+            return
+        
+        s = open(os.path.join(os.path.dirname(__file__), '../openstreetmap/roads.mss')).read().decode('utf-8')
+        s += u'\n@variables { } @\\6D edia u\\72l(x) 12px 50% f(a) U+0-7F ~= |= <!-- --> \'bad'
+        
+        self.assertEqual(list(cssTokenizer().tokenize(s)), list(Tokenizer().tokenize(s)))
+
 class SelectorTests(unittest.TestCase):
     
     def testSpecificity1(self):
@@ -164,6 +397,30 @@ class SelectorTests(unittest.TestCase):
     def testMatch11(self):
         assert Selector(SelectorElement(['*'])).matches('Map', None, [])
 
+    def testMatch12(self):
+        s = """
+            * { line-width: 1; }
+            Map { map-bgcolor: #fff; }
+            Layer { line-width: 2; }
+            #foo { line-width: 3; }
+            .bar { line-width: 4; }
+            .bar.baz { line-width: 5; }
+            Layer#foo.baz { line-width: 6; }
+            .bar.bar { line-width: 7; }
+            #foo[kind=park] { line-width: 8; }
+        """
+        declarations = stylesheet_declarations(s)
+        index = DeclarationIndex(declarations)
+        
+        for (tag, id, classes) in [('Layer', 'foo', []), ('Layer', 'foo', ['baz']), ('Layer', None, ['bar']),
+                                   ('Layer', None, ['baz', 'bar']), ('Layer', None, ['bar', 'bar']),
+                                   ('Map', None, []), ('Layer', 'bar', ['foo'])]:
+            expected = [dec for dec in declarations if dec.selector.matches(tag, id, classes)]
+            self.assertEqual(expected, index.matching(tag, id, classes))
+        
+        self.assertEqual(['1.0', '2.0', '3.0', '4.0', '5.0', '6.0', '8.0', 'map'],
+                         sorted([str(d.value) for d in index.matching('Layer', 'foo', ['baz', 'bar'])]))
+
     def testRange1(self):
         selector = Selector(SelectorElement(['*'], [SelectorAttributeTest('scale-denominator', '>', 100)]))
         assert selector.isRanged()
@@ -227,6 +484,83 @@ class SelectorTests(unittest.TestCase):
         assert not selector.inRange(100)
         assert not selector.inRange(1000)
 
+    def testScaled1(self):
+        test = SelectorAttributeTest('scale-denominator', '>', 100)
+        other = SelectorAttributeTest('name', '=', 'foo')
+        selector = Selector(SelectorElement(['Layer'], [test, other]), SelectorElement(['name']))
+        scaled = selector.scaledBy(2)
+        
+        self.assertEqual('Layer[scale-denominator>100][name=foo] name', str(selector))
+        self.assertEqual('Layer[scale-denominator>50][name=foo] name', str(scaled))
+        self.assertTrue(scaled.elements[0].tests[1] is other)
+        self.assertTrue(scaled.elements[1] is selector.elements[1])
+
+    def testScaled2(self):
+        s = 'Layer[zoom=10] { line-width: 1; &.big { line-width: 2; } }'
+        declarations = stylesheet_declarations(s, is_merc=True)
+        outer, inner = [d.selector for d in declarations[1:]]
+        
+        self.assertEqual('Layer[scale-denominator>=408561][scale-denominator<817121]', str(outer))
+        self.assertEqual('Layer.big[scale-denominator>=408561][scale-denominator<817121]', str(inner))
+        self.assertTrue(outer.elements[0].tests[0] is inner.elements[0].tests[0])
+        
+        declarations = stylesheet_declarations(s, is_merc=True, scale=2)
+        self.assertEqual('Layer[scale-denominator>=204280][scale-denominator<408560]', str(declarations[1].selector))
+        self.assertEqual([2, 4], [d.value.value for d in declarations[1:]])
+
+    def testSlots(self):
+        s = 'Layer[zoom>10] { line-width: 1; &.big[kind=major] { line-color: #f90; } }'
+        declarations = stylesheet_declarations(s, is_merc=True)
+
+        for dec in declarations:
+            for thing in [dec, dec.selector, dec.property, dec.value] + list(dec.selector.elements) + list(dec.selector.allTests()):
+                self.assertFalse(hasattr(thing, '__dict__'))
+
+        copies = cPickle.loads(cPickle.dumps(declarations, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(map(repr, declarations), map(repr, copies))
+        self.assertEqual([d.sort_key for d in declarations], [d.sort_key for d in copies])
+
+    def testInternedTests(self):
+        test = SelectorAttributeTest('kind', '=', 'park')
+        self.assertTrue(test is SelectorAttributeTest(u'kind', '=', 'park'))
+        self.assertTrue(test is cPickle.loads(cPickle.dumps(test, cPickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(1, len(set([test, SelectorAttributeTest('kind', '=', 'park')])))
+
+        # ints and floats stay apart
+        self.assertFalse(SelectorAttributeTest('size', '=', 1) is SelectorAttributeTest('size', '=', 1.0))
+        self.assertEqual('[size=1.0]', str(SelectorAttributeTest('size', '=', 1.0)))
+        self.assertNotEqual(SelectorAttributeTest('size', '=', 1), SelectorAttributeTest('size', '=', 1.0))
+
+        # other things are never equal, and don't break comparisons
+        self.assertFalse(test == None)
+        self.assertTrue(test != '[kind=park]')
+        self.assertFalse(test in [u'[kind=park]', None])
+        self.assertTrue(test in [None, SelectorAttributeTest('kind', '=', 'park')])
+
+        # scale-denominator first, then by property, operator and value
+        tests = [SelectorAttributeTest('kind', '=', 'park'), SelectorAttributeTest('kind', '!=', 'park'),
+                 SelectorAttributeTest('area', '>', 10), SelectorAttributeTest('scale-denominator', '<', 1000)]
+        self.assertEqual('[scale-denominator<1000][area>10][kind!=park][kind=park]', ''.join(map(str, sorted(tests))))
+        self.assertEqual([('scale-denominator', '<', 1000), ('area', '>', 10)], [t.key for t in sorted(tests)][:2])
+
+    def testFinalized(self):
+        s = 'Layer#foo[zoom>10][kind=park] { line-width: 1; }'
+        selector = stylesheet_declarations(s, is_merc=True)[1].selector
+
+        self.assertEqual((1, 1, 2), selector.specificity())
+        self.assertTrue(selector.allTests() is selector.allTests())
+        self.assertEqual('[scale-denominator<408561]', ''.join(map(str, selector.rangeTests())))
+        self.assertEqual(selector.rangeTests(), selector.mapScaleTests())
+        self.assertTrue(selector.isRanged() and selector.isMapScaled())
+
+        # finalized selectors can't be changed
+        self.assertRaises(AssertionError, selector.convertZoomTests, True)
+        self.assertRaises(AttributeError, selector.elements[0].addTest, SelectorAttributeTest('a', '=', 1))
+
+        scaled = selector.scaledBy(2)
+        self.assertEqual('[scale-denominator<204280]', ''.join(map(str, scaled.rangeTests())))
+        self.assertEqual('[scale-denominator<408561]', ''.join(map(str, selector.rangeTests())))
+
 class ValueTests(unittest.TestCase):
 
     def testBadValue1(self):
@@ -315,7 +649,26 @@ class ValueTests(unittest.TestCase):
 
     def testValue15(self):
         self.assertEqual(14, postprocess_value(Property('shield-line-spacing'), [('NUMBER', '14')], False, 0, 0).value)
-    
+
+    def testValue16(self):
+        # colors, booleans and identifiers are parsed once and shared
+        fill1 = postprocess_value(Property('polygon-fill'), [('HASH', '#f90')], False, 0, 0)
+        fill2 = postprocess_value(Property('line-color'), [('HASH', '#f90')], True, 0, 0)
+        self.assertTrue(fill1.value is fill2.value)
+        self.assertEqual((False, True), (fill1.important, fill2.important))
+
+        avoid1 = postprocess_value(Property('text-avoid-edges'), [('IDENT', 'true')], False, 0, 0)
+        avoid2 = postprocess_value(Property('point-allow-overlap'), [('IDENT', 'true')], False, 0, 0)
+        self.assertTrue(avoid1.value is avoid2.value)
+
+        join1 = postprocess_value(Property('line-join'), [('IDENT', 'round')], False, 0, 0)
+        join2 = postprocess_value(Property('line-join'), [('IDENT', 'round')], False, 0, 0)
+        self.assertTrue(join1.value is join2.value)
+
+        # a bad color is never cached
+        self.assertRaises(ParseException, postprocess_value, Property('polygon-fill'), [('HASH', '#badcolor')], False, 0, 0)
+        self.assertRaises(ParseException, postprocess_value, Property('polygon-fill'), [('HASH', '#badcolor')], False, 0, 0)
+
 class CascadeTests(unittest.TestCase):
 
     def testCascade1(self):
@@ -611,6 +964,139 @@ class FilterCombinationTests(unittest.TestCase):
         self.assertEqual(len(filters), 16)
         self.assertEqual(str(sorted(filters)), '[[horse!=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure!=park], [horse!=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure=park], [horse!=yes][landuse=agriculture][leisure!=park], [horse!=yes][landuse=agriculture][leisure=park], [horse!=yes][landuse=civilian][leisure!=park], [horse!=yes][landuse=civilian][leisure=park], [horse!=yes][landuse=military][leisure!=park], [horse!=yes][landuse=military][leisure=park], [horse=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure!=park], [horse=yes][landuse!=agriculture][landuse!=civilian][landuse!=military][leisure=park], [horse=yes][landuse=agriculture][leisure!=park], [horse=yes][landuse=agriculture][leisure=park], [horse=yes][landuse=civilian][leisure!=park], [horse=yes][landuse=civilian][leisure=park], [horse=yes][landuse=military][leisure!=park], [horse=yes][landuse=military][leisure=park]]')
 
+    def testFilters5(self):
+        s = """
+            Layer[landuse=military]     { polygon-fill: #000; }
+            Layer[landuse=civilian]     { polygon-fill: #001; }
+            Layer[landuse=agriculture]  { polygon-fill: #010; }
+            Layer[horse=yes]    { polygon-fill: #011; }
+            Layer[leisure=park] { polygon-fill: #100; }
+        """
+        selectors = [dec.selector for dec in stylesheet_declarations(s)]
+        tests = selectors_tests(selectors)
+        
+        # lazy generator visits every filter in the same sorted order.
+        self.assertEqual(str(list(iter_tests_filter_combinations(tests))), str(sorted(tests_filter_combinations(tests))))
+        
+        # only filters that the military selector could apply to survive.
+        military = [selector for selector in selectors if str(selector) == 'Layer[landuse=military]']
+        filters = list(iter_tests_filter_combinations(tests, military))
+        
+        self.assertEqual(len(filters), 4)
+        self.assertEqual(str(filters), '[[horse!=yes][landuse=military][leisure!=park], [horse!=yes][landuse=military][leisure=park], [horse=yes][landuse=military][leisure!=park], [horse=yes][landuse=military][leisure=park]]')
+
+class CascadeEngineTests(unittest.TestCase):
+
+    def testEngines1(self):
+        s = """
+            Layer[zoom<=10] { line-width: 1; line-color: #000; }
+            Layer[zoom>10][kind=major] { line-width: 4; }
+            Layer[kind=minor][lanes>2] { line-width: 2; }
+            Layer[kind=minor][lanes<=2] { display: none; }
+            Layer[tunnel=yes] { line-color: #999; polygon-fill: #f90; }
+            Layer[lanes=1][tunnel!=yes] { polygon-fill: #0f0 !important; }
+        """
+        declarations = stylesheet_declarations(s, is_merc=True)
+        
+        for get_rules in (get_line_rules, get_polygon_rules):
+            cartesian = get_rules(declarations, CascadeContext('cartesian'))
+            diagram = get_rules(declarations, CascadeContext('diagram'))
+            
+            self.assertTrue(len(cartesian) > 0)
+            self.assertEqual(repr(cartesian), repr(diagram))
+
+    def testCartesian1(self):
+        s = """
+            Layer { line-width: 1; line-color: #000; }
+            Layer[kind!=minor] { line-width: 2; }
+            Layer[kind!=minor][lanes>1] { line-color: #f90; }
+            Layer[lanes<=2.5] { line-width: 3; }
+            Layer[kind!=major][lanes>=1.5] { line-opacity: 0.5; }
+            Layer[lanes=2][tunnel!=yes] { line-cap: round; }
+            Layer[lanes=4] { display: none; }
+            Layer[kind=minor][tunnel=yes] { line-join: bevel; }
+        """
+        declarations = stylesheet_declarations(s)
+        context = CascadeContext('cartesian')
+        
+        # conflicts are indexed per test, so check them against every declaration
+        expected = []
+        
+        for filter in tests_filter_combinations(selectors_tests([dec.selector for dec in declarations])):
+            rule = cascade_rule([dec for dec in declarations if is_applicable_selector(dec.selector, filter)])
+            
+            if rule:
+                expected.append((filter, rule))
+        
+        self.assertTrue(len(expected) > 5)
+        self.assertEqual(repr(cartesian_cascade(declarations, context)), repr(expected))
+        self.assertEqual(context.combinations, len(tests_filter_combinations(selectors_tests([dec.selector for dec in declarations]))))
+
+    def testContext1(self):
+        s = """
+            Layer[kind=major] { line-width: 4; polygon-fill: #f90; }
+            Layer[kind=minor][lanes>2] { line-width: 2; polygon-fill: #999; }
+        """
+        declarations = stylesheet_declarations(s)
+        context = CascadeContext()
+        
+        tests = selectors_tests([dec.selector for dec in declarations])
+        groups = context.filterGroups(tests)
+        
+        # the same set of tests in any order reuses the same partition
+        self.assertTrue(context.filterGroups(list(reversed(tests))) is groups)
+        self.assertEqual(len(context.partitions), 1)
+        
+        # and so does every symbolizer family in the layer
+        get_line_rules(declarations, context)
+        get_polygon_rules(declarations, context)
+        self.assertEqual(len(context.partitions), 1)
+        
+        # equal int and float values are still different tests
+        ints = context.filterGroups([SelectorAttributeTest('lanes', '=', 2)])
+        floats = context.filterGroups([SelectorAttributeTest('lanes', '=', 2.0)])
+        self.assertEqual(len(context.partitions), 3)
+        
+        for (groups, value_type) in ((ints, int), (floats, float)):
+            for (property, choices, prefixed) in groups:
+                for (tuples, tests) in choices:
+                    self.assertEqual([value_type], [type(test.value) for test in tests])
+
+    def testCoalesce1(self):
+        s = """
+            Layer { line-color: #000; line-width: 1; }
+            Layer[zoom>=12] { line-width: 2; }
+            Layer[zoom>=14] { line-width: 2; }
+            Layer[kind=major] { line-color: #000; }
+        """
+        declarations = stylesheet_declarations(s, is_merc=True)
+        
+        # no tests on kind, and one slice of scale for each width
+        rules = get_line_rules(declarations)
+        
+        self.assertEqual(len(rules), 2)
+        self.assertEqual(rules[0].filter, None)
+        self.assertEqual(rules[1].filter, None)
+        self.assertEqual(rules[0].minscale, None)
+        self.assertEqual(rules[0].maxscale.value + 1, rules[1].minscale.value)
+        self.assertEqual(rules[1].maxscale, None)
+        self.assertEqual(rules[0].symbolizers[0].width, 2)
+        self.assertEqual(rules[1].symbolizers[0].width, 1)
+
+    def testCoalesce2(self):
+        width = stylesheet_declarations('Layer { line-width: 1; }')[0].value
+        
+        kinds = [(Filter(SelectorAttributeTest('kind', '=', 'a')), {'line-width': width}),
+                 (Filter(SelectorAttributeTest('kind', '!=', 'a')), {'line-width': width})]
+        
+        self.assertEqual(repr(coalesce_rules(kinds)), repr([(Filter(), {'line-width': width})]))
+        
+        # a missing attribute is neither less than nor at least two lanes
+        lanes = [(Filter(SelectorAttributeTest('lanes', '<', 2)), {'line-width': width}),
+                 (Filter(SelectorAttributeTest('lanes', '>=', 2)), {'line-width': width})]
+        
+        self.assertEqual(len(coalesce_rules(lanes)), 2)
+
 class NestedRuleTests(unittest.TestCase):
 
     def testCompile1(self):
@@ -870,6 +1356,55 @@ class AtVariableTests(unittest.TestCase):
         self.assertEqual(declarations[2].selector.elements[0].names[0], '.lt-blue')
         self.assertEqual(str(declarations[2].value.value), '#0066ff')
 
+    def testCompile3(self):
+        s = """
+            @dash: 2, 4;
+            @dashes: @dash, @dash;
+            @wide: 3 !important;
+            
+            .dashed { line-dasharray: @dashes; line-width: @wide; }
+        """
+        
+        declarations = stylesheet_declarations(s)
+        
+        self.assertEqual(len(declarations), 3)
+        
+        self.assertEqual(declarations[1].property.name, 'line-dasharray')
+        self.assertEqual(declarations[1].value.value.values, (2, 4, 2, 4))
+        
+        self.assertEqual(declarations[2].property.name, 'line-width')
+        self.assertEqual(declarations[2].value.value, 3)
+        self.assertTrue(declarations[2].value.important)
+
+    def testCompile4(self):
+        self.assertRaises(ParseException, stylesheet_declarations, '.blue { polygon-fill: @blue }')
+        self.assertRaises(ParseException, stylesheet_declarations, '@light-blue: @blue; .blue { polygon-fill: @light-blue }')
+        self.assertRaises(ParseException, stylesheet_declarations, '@a: @b; @b: @a; .blue { polygon-fill: @a }')
+        
+        # an undefined variable is only a problem where it's used
+        declarations = stylesheet_declarations('@light-blue: @blue; .blue { polygon-fill: #00f }')
+        self.assertEqual('#0000ff', str(declarations[1].value))
+
+    def testCompile5(self):
+        # variables can refer to variables defined after them
+        declarations = stylesheet_declarations('@a: @b; @b: #f00; Layer { polygon-fill: @a; }')
+        self.assertEqual('#ff0000', str(declarations[1].value))
+
+    def testCompile6(self):
+        # variables see the latest definition of variables they refer to
+        s = """
+            @b: #f00;
+            @a: @b;
+            Layer { polygon-fill: @a; }
+            @b: #00f;
+            Layer { line-color: @a; }
+        """
+        declarations = stylesheet_declarations(s)
+        self.assertEqual(['#ff0000', '#0000ff'], [str(d.value) for d in declarations[1:]])
+        
+        declarations = stylesheet_declarations('@b: #f00; @a: @b; @b: #00f; Layer { polygon-fill: @a; }')
+        self.assertEqual('#0000ff', str(declarations[1].value))
+
 class SimpleRangeTests(unittest.TestCase):
 
     def testRanges1(self):
@@ -1038,6 +1573,18 @@ class CompatibilityTests(unittest.TestCase):
         
         assert not is_applicable_selector(s, f)
 
+    def testCompatibility17(self):
+        # one selector against a whole filter matches checking test by test
+        ops, values = ('<', '<=', '=', '!=', '>=', '>'), (1, 2, 'a')
+
+        for (op1, value1, op2, value2) in product(ops, values, ops, values):
+            a = SelectorAttributeTest('foo', op1, value1)
+            b = SelectorAttributeTest('foo', op2, value2)
+            s = Selector(SelectorElement(['Layer'], [SelectorAttributeTest('bar', '=', 1), a]))
+            f = [SelectorAttributeTest('bar', '!=', 2), b]
+
+            self.assertEqual(a.isCompatible([b]), s.isCompatible(f))
+
 class StyleRuleTests(unittest.TestCase):
 
     def setUp(self):
@@ -2512,6 +3059,248 @@ layer_srs=%(other_srs)s
         
         self.assertEqual(str(map.background), '#000000')
 
+    def testCompile12(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 2; }
+                    .road[kind=major] { line-width: 4; }
+                    #minor { line-width: 1; }
+                </Stylesheet>
+                <Layer class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="minor" class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        map = compile(s, self.dirs)
+        
+        self.assertEqual(3, len(map.layers))
+        self.assertEqual(1, len(map.layers[0].styles))
+        
+        # same declarations, same styles
+        self.assertTrue(map.layers[0].styles[0] is map.layers[1].styles[0])
+        
+        # different declarations, different styles
+        self.assertFalse(map.layers[0].styles[0] is map.layers[2].styles[0])
+        self.assertNotEqual(map.layers[0].styles[0].name, map.layers[2].styles[0].name)
+
+    def testCompile13(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 2; }
+                    .road[kind=major] { line-width: 4; }
+                    #water { polygon-fill: #09f; }
+                    #labels name { text-face-name: 'Helvetica'; text-size: 12; }
+                </Stylesheet>
+                <Layer class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="water">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="labels">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        serial = compile(s, self.dirs, scale=2)
+        parallel = compile(s, self.dirs, scale=2, workers=2)
+        
+        self.assertEqual(len(serial.layers), len(parallel.layers))
+        
+        for (serial_layer, parallel_layer) in zip(serial.layers, parallel.layers):
+            self.assertEqual([style.name for style in serial_layer.styles],
+                             [style.name for style in parallel_layer.styles])
+            
+            for (serial_style, parallel_style) in zip(serial_layer.styles, parallel_layer.styles):
+                self.assertEqual([repr(rule) for rule in serial_style.rules],
+                                 [repr(rule) for rule in parallel_style.rules])
+
+    def testCompile14(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map srs="+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null">
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 1; }
+                    .road[zoom>=14] { line-width: 4; }
+                    #parks[zoom&lt;=8] { polygon-fill: #0f0; }
+                </Stylesheet>
+                <Layer class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="parks">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        self.assertEqual(2, len(compile(s, self.dirs).layers))
+        
+        map = compile(s, self.dirs, zooms=(14, 18))
+        
+        # parks can't be seen past zoom 8
+        self.assertEqual(1, len(map.layers))
+        self.assertEqual(1, len(map.layers[0].styles))
+        
+        # one rule for roads, clipped to zooms 14-18
+        rules = map.layers[0].styles[0].rules
+        
+        self.assertEqual(1, len(rules))
+        self.assertEqual(1596, rules[0].minscale.value)
+        self.assertEqual(51069, rules[0].maxscale.value)
+        self.assertEqual(4, rules[0].symbolizers[0].width)
+        
+        map = compile(s, self.dirs, scales=(None, 1000000))
+        
+        self.assertEqual(1, len(map.layers))
+        self.assertEqual(2, len(map.layers[0].styles[0].rules))
+        
+        self.assertRaises(Exception, compile, s, self.dirs, zooms=(14, 99))
+
+    def testCompile15(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 1; }
+                    .road[kind=major] { line-width: 4; }
+                </Stylesheet>
+                <Layer id="roads" class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        # profile first, because a second compile reads cached declarations
+        profile = compile(s, self.dirs, profile=True).profile
+        self.assertEqual(None, compile(s, self.dirs).profile)
+        
+        self.assertEqual(1, profile.phases['stylesheet_declarations'][0])
+        self.assertEqual(1, profile.phases['localize_shapefile'][0])
+        self.assertEqual(1, profile.phases['get_line_rules'][0])
+        
+        self.assertEqual(1, len(profile.layers))
+        
+        # kind=major and kind!=major, each with a line
+        name, combinations, kept, rules = profile.layers[0]
+        self.assertEqual(('#roads .road', 2, 2), (name, kept, rules))
+        self.assertTrue(combinations >= kept)
+        self.assertTrue('get_line_rules' in str(profile))
+
+    def testCompile16(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map srs="+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null">
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 1; line-opacity: 0.5; }
+                    .road[zoom>=14] { line-width: 4; line-dasharray: 2, 3; }
+                </Stylesheet>
+                <Layer class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        
+        maps = compile_scaled(s, self.dirs, [1, 2], profile=True)
+        
+        self.assertEqual(2, len(maps))
+        
+        # parsing and localizing happen once and show up in every profile,
+        # the cascade and layers only in the profile of their own map
+        for map in maps:
+            self.assertEqual(1, map.profile.phases['stylesheet_declarations'][0])
+            self.assertEqual(1, map.profile.phases['localize_shapefile'][0])
+            self.assertEqual(1, map.profile.phases['get_line_rules'][0])
+            self.assertEqual(1, len(map.profile.layers))
+        
+        for (scale, map) in zip([1, 2], maps):
+            rules = map.layers[0].styles[0].rules
+            expected = compile(s, self.dirs, scale=scale).layers[0].styles[0].rules
+            self.assertEqual([repr(rule) for rule in expected], [repr(rule) for rule in rules])
+        
+        # widths and scale denominators double, opacity does not
+        rules = maps[1].layers[0].styles[0].rules
+        self.assertEqual(25534, rules[0].maxscale.value)
+        self.assertEqual(8, rules[0].symbolizers[0].width)
+        self.assertEqual(0.5, rules[0].symbolizers[0].opacity)
+        self.assertEqual(2, rules[1].symbolizers[0].width)
+
+    def testCompile17(self):
+        """
+        """
+        s = """<?xml version="1.0"?>
+            <Map>
+                <Stylesheet>
+                    .road { line-color: #f90; line-width: 1; }
+                    .road[kind=major] { line-width: 4; }
+                </Stylesheet>
+                <Layer id="roads" class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+                <Layer id="more-roads" class="road">
+                    <Datasource>
+                        <Parameter name="type">shape</Parameter>
+                        <Parameter name="file">%(data)s/test.shp</Parameter>
+                    </Datasource>
+                </Layer>
+            </Map>
+        """ % self.__dict__
+        profile = compile(s, self.dirs, profile=True).profile
+        
+        # the second layer reuses the styles of the first, without cascading again
+        self.assertEqual(1, profile.phases['get_line_rules'][0])
+        self.assertEqual(('#roads .road', 2, 2), (profile.layers[0][0], profile.layers[0][2], profile.layers[0][3]))
+        self.assertEqual(('#more-roads .road', 0, 0, 2), profile.layers[1])
+        
+        # a failed compile leaves no profile behind
+        self.assertRaises(NotImplementedError, compile, s, self.dirs, zooms=(10, 12), profile=True)
+        self.assertEqual(None, compile_module.PROFILE)
+
 class RelativePathTests(unittest.TestCase):
 
     def setUp(self):
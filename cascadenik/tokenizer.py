@@ -0,0 +1,172 @@
+""" Single-pass CSS tokenizer, a drop-in for cssutils.tokenize2.Tokenizer.
+
+Productions and macros are copied from cssutils.cssproductions and tried
+in the same order, so token names, values, lines and columns all come out
+the same as from cssutils. The difference is that every production lives in
+one precompiled regular expression, matched in place with no slicing.
+"""
+import re
+import sys
+
+macros = [
+    ('nonascii', r'[^\0-\177]'),
+    ('nl', r'\n|\r\n|\r|\f'),
+    ('s', r'\t|\r|\n|\f|\x20'),
+    ('w', r'{s}*'),
+    ('unicode', r'\\[0-9A-Fa-f]{1,6}(?:{nl}|{s})?'),
+    ('escape', r'{unicode}|\\[^\n\r\f0-9a-f]'),
+    ('nmstart', r'[_a-zA-Z]|{nonascii}|{escape}'),
+    ('nmchar', r'[-_a-zA-Z0-9]|{nonascii}|{escape}'),
+    ('string1', r'"(?:[^\n\r\f\\"]|\\{nl}|{escape})*"'),
+    ('string2', r"'(?:[^\n\r\f\\']|\\{nl}|{escape})*'"),
+    ('invalid1', r'"(?:[^\n\r\f\\"]|\\{nl}|{escape})*'),
+    ('invalid2', r"'(?:[^\n\r\f\\']|\\{nl}|{escape})*"),
+    ('string', r'{string1}|{string2}'),
+    ('invalid', r'{invalid1}|{invalid2}'),
+    ('comment', r'\/\*[^*]*\*+(?:[^/][^*]*\*+)*\/'),
+    ('ident', r'[-]?{nmstart}{nmchar}*'),
+    ('name', r'{nmchar}+'),
+    ('num', r'[0-9]*\.[0-9]+|[0-9]+'),
+    ('url', r'[\x09\x21\x23-\x26\x28\x2a-\x7E]|{nonascii}|{escape}'),
+    ('U', r'U|u|\\0{0,4}(?:55|75)(?:\r\n|[ \t\r\n\f])?|\\U|\\u'),
+    ('R', r'R|r|\\0{0,4}(?:52|72)(?:\r\n|[ \t\r\n\f])?|\\R|\\r'),
+    ('L', r'L|l|\\0{0,4}(?:4c|6c)(?:\r\n|[ \t\r\n\f])?|\\L|\\l')
+    ]
+
+productions = [
+    ('S', r'{s}+'),
+    ('URI', r'{U}{R}{L}\({w}(?:{string}|{url}*){w}\)'),
+    ('FUNCTION', r'{ident}\('),
+    ('UNICODE-RANGE', r'{U}\+[0-9A-Fa-f?]{1,6}(?:\-[0-9A-Fa-f]{1,6})?'),
+    ('IDENT', r'{ident}'),
+    ('DIMENSION', r'{num}{ident}'),
+    ('PERCENTAGE', r'{num}\%'),
+    ('NUMBER', r'{num}'),
+    ('HASH', r'\#{name}'),
+    ('COMMENT', r'{comment}'),
+    ('STRING', r'{string}'),
+    ('INVALID', r'{invalid}'),
+    ('ATKEYWORD', r'@{ident}'),
+    ('INCLUDES', r'\~\='),
+    ('DASHMATCH', r'\|\='),
+    ('PREFIXMATCH', r'\^\='),
+    ('SUFFIXMATCH', r'\$\='),
+    ('SUBSTRINGMATCH', r'\*\='),
+    ('CDO', r'\<\!\-\-'),
+    ('CDC', r'\-\-\>'),
+    ('CHAR', r'[^"\']')
+    ]
+
+def expand_macros(pattern):
+    """ Replace {macro} references in a pattern, recursively.
+    """
+    expanded = dict()
+
+    for (name, value) in macros:
+        expanded[name] = re.sub(r'{([a-zA-Z][a-zA-Z0-9-]*)}', lambda m: '(?:%s)' % expanded[m.group(1)], value)
+
+    return re.sub(r'{([a-zA-Z][a-zA-Z0-9-]*)}', lambda m: '(?:%s)' % expanded[m.group(1)], pattern)
+
+# one named group per production, in order; the first one to match wins.
+token_pattern = re.compile('|'.join(['(?P<%s>%s)' % (name.replace('-', '_'), expand_macros(pattern))
+                                     for (name, pattern) in productions]), re.U)
+
+token_names = dict([(name.replace('-', '_'), name) for (name, pattern) in productions])
+
+bom_pattern = re.compile('\xfe\xff|\xef\xbb\xbf', re.U)
+
+unicodesub = re.compile(r'\\[0-9a-fA-F]{1,6}(?:\r\n|[\t\r\n\f\x20])?').sub
+cleanstring = re.compile(r'\\((\r\n)|[\n\r\f])').sub
+simpleescapes = re.compile(r'\\([^0-9a-fA-F])').sub
+
+# token names whose values may contain unicode escapes
+escaped_names = set(('DIMENSION', 'IDENT', 'STRING', 'URI', 'HASH', 'COMMENT',
+                     'FUNCTION', 'INVALID', 'UNICODE-RANGE'))
+
+# the most common single characters, yielded without trying any production.
+fast_chars = set(u',:;{}>+[]')
+
+atkeywords = {
+    u'@font-face': 'FONT_FACE_SYM',
+    u'@import': 'IMPORT_SYM',
+    u'@media': 'MEDIA_SYM',
+    u'@namespace': 'NAMESPACE_SYM',
+    u'@page': 'PAGE_SYM',
+    u'@variables': 'VARIABLES_SYM'
+    }
+
+def unescape(match):
+    """ Replacement for unicodesub(): a unicode escape to its character.
+    """
+    num = int(match.group(0)[1:], 16)
+
+    if num <= sys.maxunicode:
+        return unichr(num)
+
+    return match.group(0)
+
+class Tokenizer:
+    """ Generates (name, value, line, col) token tuples, like cssutils.
+    """
+    def tokenize(self, text):
+        """ Generator: tokenize text and yield tokens.
+
+            Unicode escapes in values are resolved to normal characters.
+        """
+        line = col = 1
+        pos, end = 0, len(text)
+
+        match = bom_pattern.match(text)
+
+        if match:
+            yield ('BOM', match.group(0), line, col)
+            pos = match.end()
+
+        if text.startswith('@charset ', pos):
+            yield ('CHARSET_SYM', '@charset ', line, col)
+            pos += 9
+            col += 9
+
+        match_token = token_pattern.match
+
+        while pos < end:
+            char = text[pos]
+
+            if char in fast_chars:
+                yield ('CHAR', char, line, col)
+                pos += 1
+                col += 1
+                continue
+
+            match = match_token(text, pos)
+            name, found = token_names[match.lastgroup], match.group(0)
+
+            if name in escaped_names:
+                value = unicodesub(unescape, found)
+
+                if name in ('STRING', 'INVALID'):
+                    value = cleanstring('', value)
+
+            else:
+                if name == 'ATKEYWORD':
+                    keyword = simpleescapes(r'\1', unicodesub(unescape, found)).lower()
+
+                    if keyword in atkeywords:
+                        name = atkeywords[keyword]
+
+                    elif found == '@charset' and text[pos + 8:pos + 9] == u' ':
+                        # misplaced @charset, which includes its trailing space
+                        name, found = 'CHARSET_SYM', found + u' '
+
+                value = found
+
+            yield (name, value, line, col)
+
+            pos += len(found)
+            newlines = found.count('\n')
+
+            if newlines:
+                line += newlines
+                col = len(found) - found.rfind('\n')
+            else:
+                col += len(found)
@@ -34,7 +34,7 @@ options = dict(name='cascadenik',
         'Topic :: Utilities'
         ],
         zip_safe=False,
-        scripts=['cascadenik-compile.py','cascadenik-style.py', 'cascadenik-extract-dscfg.py'],
+        scripts=['cascadenik-compile.py','cascadenik-style.py', 'cascadenik-extract-dscfg.py', 'cascadenik-benchmark.py'],
         packages=['cascadenik'],
         )
 